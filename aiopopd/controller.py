@@ -1,20 +1,81 @@
 import os
 import pwd
+import select
+import socket
 import asyncio
+import weakref
 import threading
+import subprocess
 
 from aiopopd.pop import Pop3, log
 
 
+# Environment variable used to pass the listening socket to a new process.
+LISTEN_FD_ENV = 'AIOPOPD_LISTEN_FD'
+# Environment variable with the pipe on which the new process reports that
+# it is accepting connections.
+READY_FD_ENV = 'AIOPOPD_READY_FD'
+# First file descriptor passed by systemd socket activation, see
+# sd_listen_fds(3).
+SD_LISTEN_FDS_START = 3
+
+
+def inherited_socket():
+    """Return the listening socket handed over by a previous process
+    or passed by systemd socket activation."""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        return socket.socket(fileno=int(fd))
+    n_fds = os.environ.pop('LISTEN_FDS', None)
+    pid = os.environ.pop('LISTEN_PID', None)
+    os.environ.pop('LISTEN_FDNAMES', None)
+    if n_fds is None or pid != str(os.getpid()):
+        return None
+    if int(n_fds) != 1:
+        raise SystemExit('Expected one socket from systemd, got %s' % n_fds)
+    os.set_inheritable(SD_LISTEN_FDS_START, False)
+    return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+
+def sd_notify(state):
+    """Send *state* to systemd's notification socket, see sd_notify(3)."""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(state.encode('ascii'), address)
+        except OSError:
+            log.exception('Notifying systemd failed')
+
+
+def notify_ready():
+    """Report that this process is accepting connections, to the process
+    that handed over the socket and to systemd."""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is not None:
+        try:
+            os.write(int(fd), b'1')
+        finally:
+            os.close(int(fd))
+    # MAINPID makes systemd follow a process started by handover().
+    sd_notify('READY=1\nMAINPID=%s' % os.getpid())
+
+
 class Controller:
     def __init__(self, handler, loop=None, hostname=None, port=1100, *,
-                 ready_timeout=1.0, ssl_context=None, setuid=False):
+                 ready_timeout=1.0, ssl_context=None, setuid=False,
+                 sock=None):
         self.handler = handler
         self.hostname = '::1' if hostname is None else hostname
         self.port = port
         self.ssl_context = ssl_context
+        self.sock = sock
         self.loop = asyncio.new_event_loop() if loop is None else loop
         self.server = None
+        self.sessions = weakref.WeakSet()
         self._thread = None
         self._thread_exception = None
         self.ready_timeout = os.getenv(
@@ -25,6 +86,11 @@ class Controller:
         """Allow subclasses to customize the handler/server creation."""
         return Pop3(self.handler)
 
+    def _factory(self):
+        session = self.factory()
+        self.sessions.add(session)
+        return session
+
     def drop_privileges(self):
         if self.setuid:
             nobody = pwd.getpwnam('nobody').pw_uid
@@ -32,11 +98,14 @@ class Controller:
 
     def _run(self, ready_event):
         asyncio.set_event_loop(self.loop)
+        if self.sock is not None:
+            address = dict(sock=self.sock)
+        else:
+            address = dict(host=self.hostname, port=self.port)
         try:
             self.server = self.loop.run_until_complete(
                 self.loop.create_server(
-                    self.factory, host=self.hostname, port=self.port,
-                    ssl=self.ssl_context))
+                    self._factory, ssl=self.ssl_context, **address))
             self.drop_privileges()
         except Exception as error:
             self._thread_exception = error
@@ -63,7 +132,9 @@ class Controller:
 
     def _stop(self):
         self.loop.stop()
-        for task in asyncio.Task.all_tasks(self.loop):
+        all_tasks = (getattr(asyncio, 'all_tasks', None) or
+                     asyncio.Task.all_tasks)
+        for task in all_tasks(self.loop):
             task.cancel()
 
     def stop(self):
@@ -73,6 +144,71 @@ class Controller:
         self._thread = None
         self.log_stop()
 
+    async def _drain(self, timeout):
+        self.server.close()
+        pending = [session._handler_coroutine for session in self.sessions
+                   if getattr(session, 'transport', None) is not None]
+        log.info('POP3 server draining %s session(s)', len(pending))
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=timeout)
+        remaining = [session for session in self.sessions
+                     if getattr(session, 'transport', None) is not None]
+        if remaining:
+            log.warning('Closing %s session(s) after drain timeout',
+                        len(remaining))
+            await asyncio.gather(
+                *[session.shutdown() for session in remaining],
+                return_exceptions=True)
+
+    def drain(self, timeout=30):
+        """Stop accepting connections and stop once sessions are done.
+
+        Sessions still open after *timeout* seconds are closed, and their
+        DELEs are committed as if the client had sent QUIT.
+        """
+        assert self._thread is not None, 'POP3 daemon not running'
+        future = asyncio.run_coroutine_threadsafe(
+            self._drain(timeout), self.loop)
+        future.result()
+        self.stop()
+
+    def handover(self, argv, timeout=30):
+        """Start a new server process that takes over the listening socket.
+
+        *argv* is the command line of the new process, which must pick up
+        the socket with inherited_socket() and call notify_ready() once it
+        accepts connections. Returns the process, after which drain() lets
+        this process finish its sessions. Returns None if the process
+        exits or is not ready within *timeout* seconds; this process then
+        keeps serving.
+        """
+        sock, = self.server.sockets
+        fd = sock.fileno()
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(fd)
+        env[READY_FD_ENV] = str(ready_w)
+        try:
+            process = subprocess.Popen(argv, env=env, pass_fds=(fd, ready_w))
+        except OSError:
+            log.exception('Starting new process failed')
+            os.close(ready_r)
+            return None
+        finally:
+            os.close(ready_w)
+        with open(ready_r, 'rb', buffering=0) as ready:
+            # The pipe is also readable, at EOF, if the process exits.
+            readable, _, _ = select.select([ready], [], [], timeout)
+            ok = bool(readable) and ready.read(1) == b'1'
+        if not ok:
+            if process.poll() is None:
+                process.kill()
+            log.error('New process %s did not start (exit status %s); '
+                      'still serving', process.pid, process.wait())
+            return None
+        log.info('Handed listening socket to process %s', process.pid)
+        return process
+
     def log_start(self):
         log.info("POP3 server listening on %s:%s",
                  self.hostname, self.port)
@@ -0,0 +1,98 @@
+import os
+import asyncio
+import tempfile
+import threading
+
+from aiopopd.pop import encode_message, log, OFFLOAD_THRESHOLD
+
+
+def _write_file(path, data):
+    # Runs in a thread; the write releases the GIL.
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def _encode_file(path):
+    # Runs in a worker process.
+    with open(path, 'r+b') as fp:
+        parts = encode_message(fp.read())
+        fp.seek(0)
+        fp.writelines(parts)
+        fp.truncate()
+
+
+class MessageEncoder:
+    """Encode large messages for RETR in a pool of worker processes.
+
+    The message is handed over in a temporary file in *directory*, which
+    the worker encodes in place and Pop3.push_file() then sends, so the
+    event loop only starts the copies. Call start() from another thread
+    than the event loop's, since starting the processes blocks.
+    """
+
+    def __init__(self, *, threshold=OFFLOAD_THRESHOLD, workers=2,
+                 directory=None):
+        self.threshold = threshold
+        self.workers = workers
+        self.directory = directory
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Not fork(): the server has IMAP worker threads running.
+                self._pool = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'))
+            return self._pool
+
+    def start(self):
+        pool = self._get_pool()
+        # Each task submitted while no worker is idle starts one.
+        try:
+            for future in [pool.submit(os.getpid)
+                           for _ in range(self.workers)]:
+                future.result()
+        except Exception:
+            log.exception('Starting message encoder workers failed')
+
+    async def encode(self, data, loop=None):
+        """Return a file object with *data* encoded by encode_message().
+
+        Return None if a worker process died, e.g. killed for lack of
+        memory; the caller then encodes the message itself, and the pool
+        is replaced for the following messages.
+        """
+        from concurrent.futures.process import BrokenProcessPool
+
+        loop = loop or asyncio.get_event_loop()
+        fd, path = tempfile.mkstemp(prefix='aiopopd-', dir=self.directory)
+        os.close(fd)
+        try:
+            await loop.run_in_executor(None, _write_file, path, data)
+            pool = self._get_pool()
+            try:
+                await loop.run_in_executor(pool, _encode_file, path)
+            except BrokenProcessPool:
+                log.warning('Message encoder worker died; restarting them')
+                self._discard_pool(pool)
+                loop.run_in_executor(None, self.start)
+                return None
+            return open(path, 'rb')
+        finally:
+            os.unlink(path)
+
+    def _discard_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -1,116 +1,755 @@
+import os
+import copy
+import time
 import asyncio
-from aiopopd.imap_backend import ImapBackend
+import hashlib
+from aiopopd.imap_backend import ImapBackend, LoginError
 from aiopopd.pop import log
+from aiopopd.rules import apply_rules, MAX_DEFER_POLLS
+from aiopopd.metrics import metrics
 
 
 class Message:
-    def __init__(self, uid, deleted, size):
+    def __init__(self, uid, deleted, size, folder='INBOX', msgid=None,
+                 sender=None, date=None):
         self.uid = uid
         self.deleted = deleted
         self.size = size
+        self.folder = folder
+        self.msgid = msgid
+        # Only fetched when a rule needs them; date is a Unix timestamp.
+        self.sender = sender
+        self.date = date
+
+    @classmethod
+    def from_index(cls, uid, folder, entry):
+        size, msgid, sender, date = entry
+        return cls(uid, False, size, folder, msgid, sender, date)
+
+    @property
+    def uidl(self):
+        # Gmail's X-GM-MSGID is the same in every folder (label).
+        if self.msgid is not None:
+            return 'gm%d' % self.msgid
+        # INBOX keeps the bare IMAP UID so existing clients don't download
+        # everything again; other folders get a short tag of their name.
+        if self.folder == 'INBOX':
+            return str(self.uid)
+        tag = hashlib.sha1(self.folder.encode('utf-8')).hexdigest()[:8]
+        return '%s.%s' % (tag, self.uid)
+
+
+class FolderConnection:
+    """An upstream connection and the folder it has selected.
+
+    Hold *lock* across select() and the commands that depend on it.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.folder = None
+        self.lock = asyncio.Lock()
+
+    async def select(self, folder):
+        if self.folder != folder:
+            status = await self.backend.select_folder(folder)
+            self.folder = folder
+            return status
 
 
 SEEN = br'\Seen'
+FROM_FIELD = 'BODY.PEEK[HEADER.FIELDS (FROM)]'
+# Number of messages per FETCH command when listing.
+FETCH_BATCH = 1000
+
+
+class CredentialCache:
+    """Remember recent upstream login results, shared by all sessions.
+
+    Only salted PBKDF2 hashes of the passwords are kept. Since the hash is
+    slow by design it is computed in an executor.
+    """
+
+    def __init__(self, *, ttl=300, failure_ttl=60, iterations=100000,
+                 max_users=10000, max_failures=8):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.iterations = iterations
+        self.max_users = max_users
+        self.max_failures = max_failures
+        self.salt = os.urandom(16)
+        self._users = {}
+
+    async def digest(self, loop, username, password):
+        data = ('%s\0%s' % (username, password)).encode('utf-8')
+        return await loop.run_in_executor(
+            None, hashlib.pbkdf2_hmac, 'sha256', data, self.salt,
+            self.iterations)
+
+    def lookup(self, username, digest):
+        """Return True/False for a known good/bad password, else None."""
+        entry = self._users.get(username, {}).get(digest)
+        if entry is None:
+            return None
+        ok, expires = entry
+        if expires < time.monotonic():
+            del self._users[username][digest]
+            return None
+        return ok
+
+    def store(self, username, digest, ok):
+        if username not in self._users and len(self._users) >= self.max_users:
+            # Forget the user that was added least recently.
+            del self._users[next(iter(self._users))]
+        now = time.monotonic()
+        if ok:
+            # A successful login invalidates everything else we knew.
+            self._users[username] = {digest: (True, now + self.ttl)}
+            return
+        entries = self._users.setdefault(username, {})
+        if len(entries) >= self.max_failures:
+            del entries[next(iter(entries))]
+        entries[digest] = (False, now + self.failure_ttl)
+
+
+class Maildrops:
+    """Per-account state shared by all POP3 sessions of the process.
+
+    Holds the exclusive maildrop lock of RFC 1939, the mailbox scan in
+    flight for each account so that a following session can join it
+    instead of scanning again, and the number of listings in a row that
+    deferred messages.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._scans = {}
+        self._deferred_polls = {}
+
+    def lock(self, account, owner):
+        holder = self._locks.get(account)
+        if holder is not None and holder is not owner:
+            return False
+        self._locks[account] = owner
+        return True
+
+    def unlock(self, account, owner):
+        if self._locks.get(account) is owner:
+            del self._locks[account]
+
+    def scan(self, account):
+        """Return the unfinished scan of *account* and the UIDVALIDITY of
+        each folder it lists, if any."""
+        scan = self._scans.get(account)
+        if scan is not None and not scan[0].done():
+            return scan
+
+    def add_scan(self, account, task, uidvalidity):
+        # *uidvalidity* is filled in by the scan as it selects folders.
+        self._scans[account] = task, uidvalidity
+        task.add_done_callback(lambda task: self._scan_done(account, task))
+
+    def deferred_polls(self, account):
+        """Return how many listings in a row deferred messages."""
+        return self._deferred_polls.get(account, 0)
+
+    def count_deferral(self, account, deferred):
+        if deferred:
+            self._deferred_polls[account] = self.deferred_polls(account) + 1
+        else:
+            self._deferred_polls.pop(account, None)
+
+    def _scan_done(self, account, task):
+        scan = self._scans.get(account)
+        if scan is not None and scan[0] is task:
+            del self._scans[account]
 
 
 class ImapHandler:
-    def __init__(self, *, loop=None):
+    def __init__(self, *, loop=None, credential_cache=None,
+                 max_connections=4, store=None, max_messages=None,
+                 max_bytes=None, maildrops=None, snapshot=None, limits=None):
         self.loop = loop or asyncio.get_event_loop()
+        self.credential_cache = credential_cache
+        self.maildrops = maildrops
+        self.limits = limits
+        self.account = None
+        self.max_connections = max_connections
+        self.store = store
+        self.snapshot = snapshot
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
         self.backend = None
+        self.connections = []
+        self._folder_connection = {}
+        self._uidvalidity = {}
+        self._gmail_query = None
+        self._backend = None
+        self._messages = None
+        self._listing = None
 
     async def get_backend(self, username, password):
         raise NotImplementedError
 
+    def get_limiter(self, host):
+        """Return the HostLimiter of *host*, or None if not limited."""
+        if self.limits is None:
+            return None
+        return self.limits.get(host)
+
+    def known_account(self, username):
+        """Return False if get_backend() would reject *username* anyway.
+
+        Checked before the password is hashed, so that logins to unknown
+        accounts stay cheap.
+        """
+        return True
+
+    def get_folders(self, username):
+        """Return the folders to present, or '*' for all of them."""
+        return ['INBOX']
+
+    def get_rules(self, username):
+        """Return the aiopopd.rules.Rule list applied when listing."""
+        return []
+
+    def get_window(self, username):
+        """Return the (max_messages, max_bytes) presented per session.
+
+        Either may be None for no limit. Messages are presented oldest
+        first; the rest waits for the next session.
+        """
+        return self.max_messages, self.max_bytes
+
+    def get_gmail_query(self, username):
+        """Return the X-GM-RAW query for new messages on Gmail upstreams.
+
+        Return None to use the generic SEARCH UNSEEN even on Gmail.
+        """
+        return 'is:unread'
+
     def connection_lost(self):
+        if self.maildrops is not None:
+            self.maildrops.unlock(self.account, self)
+        if self._listing is not None and not self._listing.done():
+            if self.maildrops is not None:
+                # Finish the scan for the next session of this account,
+                # then let go of the upstream connections.
+                self._listing.add_done_callback(self._listing_lost)
+                return
+            self._listing.cancel()
+        self._close_backends()
+
+    def _listing_lost(self, task):
+        if not task.cancelled():
+            task.exception()  # Don't warn about it never being retrieved
+        self._close_backends()
+
+    def _close_backends(self):
+        if self._backend is not None and not self._backend.done():
+            self._backend.add_done_callback(self._backend_lost)
+        for conn in self.connections:
+            if conn.backend is not self.backend:
+                conn.backend.connection_lost()
         if self.backend:
             self.backend.connection_lost()
 
+    @staticmethod
+    def _backend_lost(future):
+        if not future.cancelled() and future.exception() is None:
+            future.result().connection_lost()
+
     async def handle_PASS(self, server, username, password):
-        try:
-            self.backend = await self.get_backend(username, password)
-        except Exception as exn:
-            log.exception('%s %s Exception in get_backend',
-                          server.peer_str, username)
+        if not self.known_account(username):
+            log.info('%s %s Unknown account', server.peer_str, username)
             server.username = None
-            return '-ERR %s' % exn
+            return '-ERR [AUTH] authentication failed'
+        cache = self.credential_cache
+        known = None
+        if cache is not None:
+            digest = await cache.digest(self.loop, username, password)
+            known = cache.lookup(username, digest)
+            if known is False:
+                log.info('%s %s Rejected by credential cache',
+                         server.peer_str, username)
+                server.username = None
+                return '-ERR [AUTH] authentication failed'
+        if known:
+            if not self._lock_maildrop(server, username):
+                return '-ERR [IN-USE] maildrop already locked'
+            # The password worked recently, so reply at once and let the
+            # first command that needs the mailbox wait for the login.
+            self._backend = self.loop.create_task(
+                self._login(server, username, password, digest))
+        else:
+            try:
+                backend = await self.get_backend(username, password)
+            except LoginError as exn:
+                if cache is not None:
+                    cache.store(username, digest, False)
+                log.info('%s %s Upstream login failed: %s',
+                         server.peer_str, username, exn)
+                server.username = None
+                return '-ERR [AUTH] authentication failed'
+            except Exception as exn:
+                log.exception('%s %s Exception in get_backend',
+                              server.peer_str, username)
+                server.username = None
+                return '-ERR %s' % exn
+            if cache is not None:
+                cache.store(username, digest, True)
+            if not self._lock_maildrop(server, username):
+                await backend.disconnect()
+                return '-ERR [IN-USE] maildrop already locked'
+            self.backend = backend
+            self._backend = self.loop.create_future()
+            self._backend.set_result(backend)
         server.password = password
         server.state = 'TRANSACTION'
-        self.messages = await self.list_messages()
-        log.info('%s %r %s messages', server.peer_str, username,
-                 len(self.messages))
-        self.to_delete = []
+        # SEARCH resolves self._messages; the FETCH of the message sizes
+        # finishes self._listing.
+        self._messages = self.loop.create_future()
+        shared = None
+        if self.maildrops is not None:
+            shared = self.maildrops.scan(username)
+        self._listing = self.loop.create_task(
+            self.list_messages(server, username, password, shared))
+        if self.maildrops is not None:
+            self.maildrops.add_scan(username, self._listing,
+                                    self._uidvalidity)
         return '+OK remote login successful'
 
-    async def list_messages(self):
-        n_messages = await self.backend.select_folder('INBOX')
-        if n_messages == 0:
-            log.warning('%s %r SELECT returned 0 meaning no messages in inbox',
+    def _lock_maildrop(self, server, username):
+        if self.maildrops is None:
+            return True
+        if not self.maildrops.lock(username, self):
+            log.warning('%s %r Maildrop is in use by another session',
                         server.peer_str, username)
-            return []
-        message_ids = await self.backend.search()
-        params = [
-            'FLAGS', 'RFC822.SIZE',
-            # 'BODY.PEEK[HEADER.FIELDS (Date From To Cc Subject ' +
-            # 'Message-ID References In-Reply-To)]',
-        ]
-        data = await self.backend.fetch(message_ids, params)
-
-        def is_deleted(imap_flags):
-            return SEEN in imap_flags
-
-        def parse(message_key, message_value):
-            message_value.pop(b'SEQ', None)
-            deleted = is_deleted(message_value.pop(b'FLAGS'))
-            size = message_value.pop(b'RFC822.SIZE')
-            return Message(message_key, deleted, size)
-
-        all_messages = (parse(k, v) for k, v in data.items())
-        return [m for m in all_messages if not m.deleted]
+            server.username = None
+            return False
+        self.account = username
+        return True
+
+    async def _login(self, server, username, password, digest):
+        try:
+            backend = await self.get_backend(username, password)
+        except LoginError:
+            self.credential_cache.store(username, digest, False)
+            raise
+        self.backend = backend
+        return backend
+
+    async def list_messages(self, server, username, password, shared=None):
+        # Commands wait on self._messages, so it must be resolved however
+        # the listing ends.
+        try:
+            return await self._list_messages(server, username, password,
+                                             shared)
+        except asyncio.CancelledError:
+            self._messages.cancel()
+            raise
+        except Exception as exn:
+            if not self._messages.done():
+                self._messages.set_exception(exn)
+            raise
+
+    async def _list_messages(self, server, username, password, shared):
+        if shared is not None:
+            task, uidvalidity = shared
+            await asyncio.wait([task])
+            if not task.cancelled() and task.exception() is None:
+                # DELE records the UIDVALIDITY of the message's folder.
+                self._uidvalidity.update(uidvalidity)
+                return await self._join_scan(server, username,
+                                             task.result())
+        backend = await asyncio.shield(self._backend)
+        gmail_query = self.get_gmail_query(username)
+        if (gmail_query is not None and
+                await backend.has_capability('X-GM-EXT-1')):
+            self._gmail_query = gmail_query
+        folders = self.get_folders(username)
+        if folders == '*':
+            folders = await self._list_all_folders(backend)
+        await self._open_connections(backend, username, password,
+                                     len(folders))
+        # Split the folders into contiguous runs, one per connection.
+        n = len(self.connections)
+        assignment = [(conn, folders[i * len(folders) // n:
+                                     (i + 1) * len(folders) // n])
+                      for i, conn in enumerate(self.connections)]
+        for conn, conn_folders in assignment:
+            for folder in conn_folders:
+                self._folder_connection[folder] = conn
+        if self.store is not None:
+            deleted = await self.store.get_deleted(username)
+        else:
+            deleted = {}
+        found = await asyncio.gather(
+            *[self._search_folders(conn, conn_folders, username, deleted)
+              for conn, conn_folders in assignment])
+        by_folder = {}
+        for results in found:
+            by_folder.update(results)
+        messages = [m for folder in folders for m in by_folder[folder]]
+        if self._gmail_query is not None:
+            messages = self._skip_duplicates(messages)
+        rules = self.get_rules(username)
+        max_messages, max_bytes = self.get_window(username)
+        if self.store is not None and (max_messages is not None or
+                                       max_bytes is not None):
+            messages = await self._retrieved_last(username, messages)
+        backlog = []
+        if max_messages is not None and not rules:
+            # Only the messages in the window need their sizes fetched.
+            messages, backlog = messages[:max_messages], messages[max_messages:]
+        if rules or max_bytes is not None:
+            # The rules and the byte limit decide which messages get a
+            # number, so they must run before the message list is ready.
+            headers = any(rule.needs_headers for rule in rules)
+            await self._fetch_messages(assignment, messages, headers)
+            present_deferred = (
+                self.maildrops is not None and
+                self.maildrops.deferred_polls(username) >= MAX_DEFER_POLLS)
+            messages, deferred, skipped = apply_rules(rules, messages,
+                                                      present_deferred)
+            if self.maildrops is not None:
+                self.maildrops.count_deferral(username, deferred)
+            messages, rest = self._window(messages, max_messages, max_bytes)
+            backlog += rest
+            self._messages.set_result(messages)
+        else:
+            deferred = skipped = []
+            self._messages.set_result(messages)
+            await self._fetch_messages(assignment, messages, False)
+        log.info('%s %r %s messages in %s folder(s), %s deferred, '
+                 '%s skipped, %s left for later', server.peer_str, username,
+                 len(messages), len(folders), len(deferred), len(skipped),
+                 len(backlog))
+        pending = messages + deferred + backlog
+        metrics.set('aiopopd_account_pending_messages', len(pending),
+                    account=username)
+        # Sizes of backlog messages are only known if they were fetched
+        # for the byte limit or are in the state store's index.
+        metrics.set('aiopopd_account_pending_bytes',
+                    sum(m.size or 0 for m in pending), account=username)
+        metrics.set('aiopopd_account_deferred_messages', len(deferred),
+                    account=username)
+        metrics.set('aiopopd_account_skipped_messages', len(skipped),
+                    account=username)
+        metrics.set('aiopopd_account_window_messages', len(messages),
+                    account=username)
+        metrics.set('aiopopd_account_window_bytes',
+                    sum(m.size for m in messages), account=username)
+        metrics.set('aiopopd_account_backlog_messages', len(backlog),
+                    account=username)
+        for folder in folders:
+            uidvalidity = self._uidvalidity.get(folder)
+            if uidvalidity is None:
+                continue
+            known = [m for m in by_folder[folder] if m.size is not None]
+            if self.store is not None:
+                self.store.put_index(username, folder, uidvalidity, known)
+            if self.snapshot is not None:
+                self.snapshot.put(username, folder, uidvalidity, known)
+        return messages
+
+    async def _fetch_messages(self, assignment, messages, headers):
+        by_folder = {}
+        for m in messages:
+            by_folder.setdefault(m.folder, []).append(m)
+        await asyncio.gather(
+            *[self._fetch_details(conn, conn_folders, by_folder, headers)
+              for conn, conn_folders in assignment])
+
+    async def _retrieved_last(self, username, messages):
+        # A client that leaves a copy on the server never deletes, so the
+        # window moves on past the messages it has retrieved instead.
+        retrieved = await self.store.get_retrieved(username)
+        if not retrieved:
+            return messages
+        new = []
+        old = []
+        for m in messages:
+            key = m.folder, self._uidvalidity.get(m.folder), m.uid
+            (old if key in retrieved else new).append(m)
+        return new + old
+
+    @staticmethod
+    def _window(messages, max_messages, max_bytes):
+        """Split *messages* into this session's window and the rest."""
+        n = total = 0
+        for m in messages:
+            if max_messages is not None and n >= max_messages:
+                break
+            # Always present at least one message, however large.
+            if max_bytes is not None and n and total + m.size > max_bytes:
+                break
+            n += 1
+            total += m.size
+        return messages[:n], messages[n:]
+
+    async def _join_scan(self, server, username, found):
+        # The scan was started by a session that has since disconnected.
+        # Its upstream connections go away with it, so RETR goes through
+        # our own connection, which selects folders as needed.
+        backend = await asyncio.shield(self._backend)
+        messages = []
+        for m in found:
+            # Messages that the earlier client deleted are already in its
+            # hands, and the state store flags them upstream later. Without
+            # a store nothing will, so they are presented again, as a new
+            # scan would.
+            if not m.deleted or self.store is None:
+                m = copy.copy(m)
+                m.deleted = False
+                messages.append(m)
+        conn = FolderConnection(backend)
+        self.connections = [conn]
+        for m in messages:
+            self._folder_connection[m.folder] = conn
+        self._messages.set_result(messages)
+        log.info('%s %r %s messages from an earlier scan', server.peer_str,
+                 username, len(messages))
+        return messages
+
+    async def _list_all_folders(self, backend):
+        folders = []
+        for flags, delimiter, name in await backend.list_folders():
+            if br'\Noselect' not in flags and br'\NonExistent' not in flags:
+                folders.append(name)
+        return folders
+
+    async def _open_connections(self, backend, username, password, n_folders):
+        self.connections = [FolderConnection(backend)]
+        n = min(self.max_connections, n_folders) - 1
+        if n <= 0:
+            return
+        spare = backend.spare_connections()
+        if spare is not None:
+            # Extra connections must not wait for a free one, or sessions
+            # holding their first connection could wait for each other.
+            n = min(n, spare)
+            if n <= 0:
+                return
+        results = await asyncio.gather(
+            *[self.get_backend(username, password) for _ in range(n)],
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                log.warning('Extra connection for %r failed: %s',
+                            username, result)
+            else:
+                self.connections.append(FolderConnection(result))
+
+    async def _search_folders(self, conn, folders, username, deleted):
+        results = {}
+        async with conn.lock:
+            for folder in folders:
+                status = await conn.backend.select_folder(folder)
+                conn.folder = folder
+                uidvalidity = status.get(b'UIDVALIDITY')
+                self._uidvalidity[folder] = uidvalidity
+                if deleted.get(folder):
+                    # Finish the flag update of a session that ended
+                    # without QUIT, before it shows up in the search.
+                    # UIDs from another UIDVALIDITY name other messages.
+                    uids = [uid for v, uid in deleted[folder]
+                            if v is not None and v == uidvalidity]
+                    stale = len(deleted[folder]) - len(uids)
+                    if stale:
+                        log.warning('%r Drop %s deletion(s) in %r left by '
+                                    'an earlier session under another '
+                                    'UIDVALIDITY', username, stale, folder)
+                    if uids:
+                        log.info('%r Delete %s message(s) in %r left by an '
+                                 'earlier session', username, len(uids),
+                                 folder)
+                        await conn.backend.add_flags(uids, [SEEN])
+                    self.store.unmark_deleted(
+                        username, folder, [uid for _, uid in deleted[folder]])
+                if status[b'EXISTS'] == 0:
+                    results[folder] = []
+                    continue
+                known = await self._get_index(username, folder)
+                if self._gmail_query is not None:
+                    results[folder] = await self._gmail_search(
+                        conn.backend, folder, known)
+                    continue
+                uids = sorted(await conn.backend.search('UNSEEN'))
+                results[folder] = [
+                    Message.from_index(uid, folder, known[uid])
+                    if uid in known else Message(uid, False, None, folder)
+                    for uid in uids]
+        return results
+
+    async def _get_index(self, username, folder):
+        uidvalidity = self._uidvalidity.get(folder)
+        if uidvalidity is None:
+            return {}
+        if self.snapshot is not None:
+            known = self.snapshot.get(username, folder, uidvalidity)
+            if known or self.store is None:
+                return known
+        if self.store is None:
+            return {}
+        return await self.store.get_index(username, folder, uidvalidity)
+
+    async def _gmail_search(self, backend, folder, known):
+        # The X-GM-MSGID is needed before the folders can be merged, so
+        # fetch it together with the size right away.
+        uids = sorted(await backend.gmail_search(self._gmail_query))
+        # Entries written by a plain SEARCH, before gmail_query was set,
+        # have no X-GM-MSGID.
+        missing = [uid for uid in uids
+                   if uid not in known or known[uid][1] is None]
+        if missing:
+            data = await backend.fetch(missing, ['X-GM-MSGID', 'RFC822.SIZE'])
+            for uid in missing:
+                sender, date = known.get(uid, (None, None, None, None))[2:]
+                known[uid] = (data[uid][b'RFC822.SIZE'],
+                              data[uid][b'X-GM-MSGID'], sender, date)
+        return [Message.from_index(uid, folder, known[uid]) for uid in uids]
+
+    @staticmethod
+    def _skip_duplicates(messages):
+        # A Gmail message with several labels shows up in several folders;
+        # present (and fetch) only the first copy.
+        seen = set()
+        result = []
+        for m in messages:
+            if m.msgid is None:
+                result.append(m)
+            elif m.msgid not in seen:
+                seen.add(m.msgid)
+                result.append(m)
+        return result
+
+    async def _fetch_details(self, conn, folders, by_folder, headers):
+        params = ['RFC822.SIZE']
+        if headers:
+            params += ['INTERNALDATE', FROM_FIELD]
+        async with conn.lock:
+            # Start with the folder that is still selected, and end with
+            # the first one, which RETR will most likely want first.
+            for folder in reversed(folders):
+                messages = [m for m in by_folder.get(folder, ())
+                            if m.size is None or (headers and m.date is None)]
+                if not messages:
+                    continue
+                await conn.select(folder)
+                for i in range(0, len(messages), FETCH_BATCH):
+                    batch = messages[i:i + FETCH_BATCH]
+                    data = await conn.backend.fetch(
+                        [m.uid for m in batch], params)
+                    for m in batch:
+                        self._parse_details(m, data[m.uid], headers)
+
+    @staticmethod
+    def _parse_details(m, data, headers):
+        m.size = data[b'RFC822.SIZE']
+        if not headers:
+            return
+        m.date = data[b'INTERNALDATE'].timestamp()
+        # The email package is only needed by rules, so it is not
+        # imported at startup.
+        import email.utils
+        import email.parser
+
+        header = data.get(b'BODY[HEADER.FIELDS (FROM)]', b'')
+        sender = email.parser.BytesHeaderParser().parsebytes(header)['From']
+        m.sender = email.utils.parseaddr(str(sender or ''))[1].lower()
+
+    async def get_messages(self):
+        """Return the message list, which may still lack sizes."""
+        return await asyncio.shield(self._messages)
+
+    async def get_sizes(self):
+        """Return the message list once the sizes are known."""
+        return await asyncio.shield(self._listing)
 
     async def handle_QUIT(self, server):
-        if server.state == 'TRANSACTION':
-            to_delete = [m.uid for m in self.messages if m.deleted]
-            if to_delete:
-                log.info('%s %s Delete %s message(s)',
-                         server.peer_str, server.username, len(to_delete))
-                await self.backend.add_flags(to_delete, [SEEN])
+        if self._listing is not None and not self._listing.done():
+            # Don't hold up QUIT for the rest of the scan.
+            self._listing.cancel()
+        if (server.state == 'TRANSACTION' and self._messages.done() and
+                not self._messages.cancelled() and
+                self._messages.exception() is None):
+            to_delete = {}
+            for m in self._messages.result():
+                if m.deleted:
+                    to_delete.setdefault(m.folder, []).append(m.uid)
+            for folder, uids in to_delete.items():
+                log.info('%s %s Delete %s message(s) in %r',
+                         server.peer_str, server.username, len(uids), folder)
+                conn = self._folder_connection[folder]
+                async with conn.lock:
+                    await conn.select(folder)
+                    await conn.backend.add_flags(uids, [SEEN])
+                if self.store is not None:
+                    self.store.unmark_deleted(server.username, folder, uids)
+            if self.store is not None:
+                await self.store.flush()
+        if self._backend is not None:
+            try:
+                await asyncio.shield(self._backend)
+            except Exception:
+                pass
+        for conn in self.connections:
+            if conn.backend is not self.backend:
+                await conn.backend.disconnect()
+        self.connections = []
         if self.backend is not None:
             await self.backend.disconnect()
             self.backend = None
+        if self.maildrops is not None:
+            self.maildrops.unlock(self.account, self)
         return '+OK Bye'
 
     async def handle_STAT(self, server):
-        n = sum(1 for m in self.messages if not m.deleted)
-        size = sum(m.size for m in self.messages if not m.deleted)
+        messages = await self.get_sizes()
+        n = sum(1 for m in messages if not m.deleted)
+        size = sum(m.size for m in messages if not m.deleted)
         return '+OK %s %s' % (n, size)
 
     async def handle_LIST(self, server, n):
-        m = self.messages[n-1]
+        m = (await self.get_sizes())[n-1]
         if not m.deleted:
             return m.size
 
     async def handle_UIDL(self, server, n):
-        m = self.messages[n-1]
+        m = (await self.get_messages())[n-1]
         if not m.deleted:
-            return m.uid
+            return m.uidl
 
     async def handle_RETR(self, server, n):
-        m = self.messages[n-1]
+        m = (await self.get_messages())[n-1]
         if m.deleted:
             return '-ERR message deleted'
         params = ['RFC822']
-        data, = (await self.backend.fetch([m.uid], params)).values()
-        await server.push_multi('+OK message follows', data[b'RFC822'])
+        conn = self._folder_connection[m.folder]
+        async with conn.lock:
+            await conn.select(m.folder)
+            data, = (await conn.backend.fetch([m.uid], params)).values()
+        await server.push_message('+OK message follows', data[b'RFC822'])
+        uidvalidity = self._uidvalidity.get(m.folder)
+        if self.store is not None and uidvalidity is not None:
+            self.store.mark_retrieved(server.username, m.folder, uidvalidity,
+                                      [m.uid])
 
     async def handle_DELE(self, server, n):
-        m = self.messages[n-1]
+        m = (await self.get_messages())[n-1]
         if m.deleted:
             return '-ERR message already deleted'
         m.deleted = True
+        if self.store is not None:
+            self.store.mark_deleted(server.username, m.folder,
+                                    self._uidvalidity.get(m.folder), [m.uid])
         return '+OK deleted'
 
     async def handle_RSET(self, server):
-        for m in self.messages:
+        for m in await self.get_messages():
+            if m.deleted and self.store is not None:
+                self.store.unmark_deleted(server.username, m.folder, [m.uid])
             m.deleted = False
         return '+OK'
 
@@ -124,7 +763,13 @@ class ImapHandlerFixed(ImapHandler):
 
     async def get_backend(self, username, password):
         backend = ImapBackend(loop=self.loop, host=self.hostname,
-                              port=self.port, ssl=self.ssl)
-        await backend.connect()
-        await backend.login(username, password)
+                              port=self.port, ssl=self.ssl,
+                              limiter=self.get_limiter(self.hostname),
+                              account=username)
+        try:
+            await backend.connect()
+            await backend.login(username, password)
+        except BaseException:
+            backend.connection_lost()
+            raise
         return backend
@@ -1,115 +1,174 @@
-import os
-import re
 import ssl
+import time
 import queue
-import asyncio
 import threading
-# Import encodings.idna to prevent LookupError on some systems
-import encodings.idna  # noqa
 
-from imapclient import IMAPClient
-import email
-import imapclient
+from aiopopd.limiter import is_body_fetch, is_throttled
+from aiopopd.tracing import current_span, response_size
+
+
+class LoginError(Exception):
+    """The IMAP server rejected the username or password."""
+
+
+def _resolve(future, result, exn, finished):
+    # Called on the event loop by the worker thread.
+    try:
+        if finished is not None:
+            finished(exn)
+    finally:
+        if not future.cancelled():
+            if exn is not None:
+                future.set_exception(exn)
+            else:
+                future.set_result(result)
 
 
 class ImapBackend:
     BREAK = object()
-    NOOP = object()
 
-    def __init__(self, loop, host, port, ssl):
+    def __init__(self, loop, host, port, ssl, *, limiter=None, account=None):
         self._loop = loop
         self._host = host
         self._port = port
         self._ssl = ssl
-        self._command_queue = queue.Queue()
-        self._response_queue = queue.Queue()
-        self._ready_r, self._ready_w = os.pipe()
-        self._loop.add_reader(self._ready_r, self._ready)
-        self._ready = threading.Event()
+        # A HostLimiter shared by the backends of all accounts on the host,
+        # which queues the commands of *account* over its limit.
+        self._limiter = limiter
+        self._account = account
+        self._command_queue = queue.SimpleQueue()
         self._thread = threading.Thread(None, self._run)
+        self._conn = None
         self._breaking = False
-
-    def __del__(self):
-        if self._ready_r is not None:
-            os.close(self._ready_r)
-            os.close(self._ready_w)
-            self._ready_r = self._ready_w = None
+        self._holds_connection = False
 
     def connection_lost(self):
-        self._loop.remove_reader(self._ready_r)
-        os.close(self._ready_r)
-        os.close(self._ready_w)
-        self._ready_r = self._ready_w = None
+        # The worker finishes the queued commands and then exits.
+        self._break()
+
+    def _break(self):
+        if not self._breaking:
+            self._breaking = True
+            self._command_queue.put((None, self.BREAK, (), None, None))
+
+    def _connect(self):
+        # imapclient is imported by the first connection's worker thread,
+        # not at startup.
+        from imapclient import IMAPClient
+        # Import encodings.idna to prevent LookupError on some systems
+        import encodings.idna  # noqa
+
+        if self._ssl:
+            kwargs = dict(
+                ssl_context=ssl.create_default_context())
+        else:
+            kwargs = {}
+        self._conn = IMAPClient(self._host, self._port, ssl=self._ssl,
+                                **kwargs)
 
     async def connect(self):
+        if self._limiter is not None:
+            await self._limiter.open_connection()
+            self._holds_connection = True
         self._thread.start()
+        await self._call(self._connect)
 
     async def disconnect(self):
-        await self.logout()
-        await self._call(self.BREAK)
-        self._thread.join()
+        try:
+            await self.logout()
+        finally:
+            self._break()
+
+    def spare_connections(self):
+        """Return how many more connections to the host may be opened
+        without waiting, or None if they are not limited."""
+        if self._limiter is None:
+            return None
+        return self._limiter.spare_connections()
 
     async def _call(self, method, *args):
         if self._breaking:
             raise Exception('connection is closing')
-        future = asyncio.Future(loop=self._loop)
-        self._command_queue.put_nowait((future, method, args))
-        if method is self.BREAK:
-            self._breaking = True
-        result = await future
-        if isinstance(result, Exception):
-            raise result
-        return result
+        if self._limiter is None:
+            return await self._submit(method, args)
+        limiter = self._limiter
+        await limiter.acquire(self._account)
+        if self._breaking:
+            # Queued behind BREAK, the command would never run.
+            limiter.return_slot()
+            raise Exception('connection is closing')
+        name = method if isinstance(method, str) else method.__name__
+        started = time.monotonic()
+        if name == 'fetch' and is_body_fetch(args[1]):
+            # Its time depends on the message size, not on the host's load.
+            name = None
+
+        def finished(exn):
+            # The slot is returned when the worker is done with the
+            # command, even if the caller was cancelled before that.
+            latency = None if name is None else time.monotonic() - started
+            limiter.release(name, latency,
+                            exn is not None and is_throttled(exn))
+
+        return await self._submit(method, args, finished)
+
+    async def _submit(self, method, args, finished=None):
+        future = self._loop.create_future()
+        span = current_span.get()
+        if span is None:
+            self._command_queue.put((future, method, args, None, finished))
+            return await future
+        name = method if isinstance(method, str) else method.__name__
+        call = span.trace.start_imap_call(span, name.strip('_'))
+        self._command_queue.put((future, method, args, call, finished))
+        try:
+            return await future
+        finally:
+            call.done()
 
     def _run(self):
-        # Run commands in thread
-        if self._ssl:
-            kwargs = dict(
-                ssl_context=ssl.create_default_context())
-        else:
-            kwargs = {}
-        try:
-            conn = IMAPClient(self._host, self._port, ssl=self._ssl, **kwargs)
-        except Exception as exn:
-            future, method, args = self._command_queue.get()
-            self._response_queue.put((future, exn))
-            self._command_queue.task_done()
-            os.write(self._ready_w, b'x')
-            return
+        # Run commands in thread. Results are handed to the event loop
+        # with call_soon_threadsafe(), which resolves the future directly.
+        from imapclient.exceptions import LoginError as ImapLoginError
+
+        call_soon = self._loop.call_soon_threadsafe
         shutdown_called = False
         try:
             while True:
-                future, method, args = self._command_queue.get()
-                if method in ('shutdown', 'logout'):
-                    shutdown_called = True
+                future, method, args, call, finished = (
+                    self._command_queue.get())
                 if method is self.BREAK:
                     break
-                elif method is self.NOOP:
-                    result = None
-                else:
-                    # TODO check if future is cancelled
-                    try:
-                        result = getattr(conn, method)(*args)
-                    except Exception as exn:
-                        result = exn
-                self._response_queue.put((future, result))
-                self._command_queue.task_done()
-                os.write(self._ready_w, b'x')
+                if method in ('shutdown', 'logout'):
+                    shutdown_called = True
+                result = exn = None
+                if call is not None:
+                    call.started = time.time_ns()
+                try:
+                    if callable(method):
+                        result = method(*args)
+                    else:
+                        result = getattr(self._conn, method)(*args)
+                except ImapLoginError as e:
+                    exn = LoginError(*e.args)
+                except Exception as e:
+                    exn = e
+                if call is not None:
+                    call.finished = time.time_ns()
+                    call.response_bytes = response_size(result)
+                call_soon(_resolve, future, result, exn, finished)
         finally:
-            if not shutdown_called:
-                conn.shutdown()
-
-        assert method is self.BREAK
-        self._response_queue.put((future, None))
-        self._command_queue.task_done()
-        os.write(self._ready_w, b'x')
-
-    def _ready(self):
-        os.read(self._ready_r, 1)
-        future, result = self._response_queue.get_nowait()
-        if not future.cancelled():
-            future.set_result(result)
-        self._response_queue.task_done()
+            if self._conn is not None and not shutdown_called:
+                try:
+                    self._conn.shutdown()
+                except Exception:
+                    pass
+            if self._holds_connection:
+                try:
+                    call_soon(self._limiter.close_connection)
+                except RuntimeError:
+                    # The event loop is closed, and the limiter with it.
+                    pass
 
     # The following methods were generated by gen-imap.py
     async def add_flags(self, messages, flags, silent=False):
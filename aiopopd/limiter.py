@@ -0,0 +1,207 @@
+import time
+import asyncio
+import collections
+
+from aiopopd.metrics import metrics
+
+
+# Response codes (RFC 5530) and texts with which IMAP servers refuse a
+# command or a connection because of load.
+THROTTLE_MARKERS = (
+    '[LIMIT]',
+    '[THROTTLED]',
+    '[UNAVAILABLE]',
+    'Too many simultaneous connections',
+)
+
+
+def is_throttled(exn):
+    if isinstance(exn, (ConnectionRefusedError, ConnectionResetError)):
+        return True
+    text = str(exn)
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+def is_body_fetch(data):
+    """Whether a FETCH of the items *data* returns message contents,
+    rather than sizes, flags or header fields."""
+    if isinstance(data, (str, bytes)):
+        data = [data]
+    for item in data:
+        if isinstance(item, bytes):
+            item = item.decode('ascii', 'replace')
+        item = item.upper().replace('.PEEK[', '[')
+        if item in ('RFC822', 'RFC822.TEXT'):
+            return True
+        if (item.startswith(('BODY[', 'BINARY[')) and
+                not item.startswith(('BODY[HEADER', 'BINARY[HEADER'))):
+            return True
+    return False
+
+
+class HostLimiter:
+    """Limit the IMAP commands in flight against one upstream host.
+
+    The limit adapts in AIMD fashion: it grows by one for each limit's
+    worth of commands that complete normally, and is halved when the host
+    refuses a command because of load, or takes more than *tolerance*
+    times its usual time for that command. It is halved at most once per
+    usual command time, so one burst of failures counts once. Commands
+    whose time depends on the size of the response, like FETCH of message
+    bodies, are released without a latency and only count as completed.
+
+    Commands over the limit wait in one queue per account, and the queues
+    are served in turn, so a large listing of one account does not hold
+    up the logins of the others.
+
+    Open connections to the host are limited to *max_connections*
+    separately; a new connection waits for one to close.
+    """
+
+    def __init__(self, host, *, initial=4, minimum=1, maximum=32,
+                 tolerance=3.0, max_connections=64):
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.max_connections = max_connections
+        self.in_flight = 0
+        self.queued = 0
+        self.throttled = 0
+        self.connections = 0
+        self._queues = collections.OrderedDict()
+        self._connection_waiters = collections.deque()
+        self._latency = {}
+        self._last_decrease = 0.0
+        self._update_metrics()
+
+    def _update_metrics(self):
+        metrics.set('aiopopd_upstream_in_flight', self.in_flight,
+                    host=self.host)
+        metrics.set('aiopopd_upstream_queued', self.queued, host=self.host)
+        metrics.set('aiopopd_upstream_limit', int(self.limit),
+                    host=self.host)
+        metrics.set('aiopopd_upstream_connections', self.connections,
+                    host=self.host)
+
+    async def acquire(self, account):
+        if self.in_flight < int(self.limit) and not self.queued:
+            self.in_flight += 1
+            self._update_metrics()
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._queues.setdefault(account, collections.deque()).append(future)
+        self.queued += 1
+        self._update_metrics()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # _grant() drops cancelled futures it comes across, so this
+                # one may have left the queue already.
+                queue = self._queues.get(account)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._queues[account]
+                    self.queued -= 1
+                    self._update_metrics()
+            else:
+                # Granted just before the cancellation.
+                self.return_slot()
+            raise
+
+    def return_slot(self):
+        """Return a slot taken by acquire() for a command that never ran."""
+        self.in_flight -= 1
+        self._grant()
+
+    def _grant(self):
+        while self.queued and self.in_flight < int(self.limit):
+            account, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(account)
+            else:
+                del self._queues[account]
+            self.queued -= 1
+            if future.done():
+                # Cancelled, but its task has not run yet to dequeue it.
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+        self._update_metrics()
+
+    async def open_connection(self):
+        """Wait until another connection to the host may be opened."""
+        if (self.connections < self.max_connections and
+                not self._connection_waiters):
+            self.connections += 1
+            self._update_metrics()
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._connection_waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if future in self._connection_waiters:
+                    self._connection_waiters.remove(future)
+            else:
+                self.close_connection()
+            raise
+
+    def spare_connections(self):
+        """Return how many connections may be opened without waiting."""
+        if self._connection_waiters:
+            return 0
+        return self.max_connections - self.connections
+
+    def close_connection(self):
+        self.connections -= 1
+        while (self._connection_waiters and
+               self.connections < self.max_connections):
+            future = self._connection_waiters.popleft()
+            if not future.done():
+                self.connections += 1
+                future.set_result(None)
+        self._update_metrics()
+
+    def release(self, method, latency, throttled):
+        """Return a slot taken by acquire(), and adapt the limit.
+
+        *latency* is None for a command that tells nothing about the load.
+        """
+        self.in_flight -= 1
+        usual = self._latency.get(method)
+        if throttled:
+            self.throttled += 1
+            metrics.add('aiopopd_upstream_throttled_total', host=self.host)
+        elif latency is not None:
+            self._latency[method] = (latency if usual is None else
+                                     usual + 0.1 * (latency - usual))
+        if throttled or (usual is not None and latency is not None and
+                         latency > self.tolerance * usual):
+            now = time.monotonic()
+            if now - self._last_decrease > (usual or latency or 0):
+                self._last_decrease = now
+                self.limit = max(self.minimum, self.limit / 2)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._grant()
+
+
+class UpstreamLimits:
+    """The HostLimiter of each upstream host, created on first use."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.hosts = {}
+
+    def get(self, host):
+        try:
+            return self.hosts[host]
+        except KeyError:
+            limiter = self.hosts[host] = HostLimiter(host, **self.kwargs)
+            return limiter
@@ -0,0 +1,56 @@
+import os
+import asyncio
+import logging
+
+
+log = logging.getLogger('aiopopd.log')
+
+
+class Metrics:
+    """Named gauges with labels, written out in Prometheus text format.
+
+    The file is meant for node_exporter's textfile collector, or for
+    reading by hand.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values.setdefault(name, {})[key] = value
+
+    def add(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+    def format(self):
+        lines = []
+        for name in sorted(self.values):
+            for key, value in sorted(self.values[name].items()):
+                if key:
+                    labels = ','.join(
+                        '%s="%s"' % (k, str(v).replace('"', r'\"'))
+                        for k, v in key)
+                    lines.append('%s{%s} %s' % (name, labels, value))
+                else:
+                    lines.append('%s %s' % (name, value))
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write(self.format())
+        os.replace(tmp, path)
+
+    async def export(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write(path)
+            except OSError:
+                log.exception('Writing metrics to %r failed', path)
+
+
+metrics = Metrics()
@@ -1,12 +1,72 @@
+import time
 import socket
 import asyncio
 import logging
 
+from aiopopd.tracing import tracer, current_span
+from aiopopd.metrics import metrics
+
 
 VERSION = '0.1'
 IDENT = 'Python POP3 {}'.format(VERSION)
 log = logging.getLogger('aiopopd.log')
 MISSING = object()
+# Size of the memoryview slices handed to the transport when sending a
+# pre-stuffed message.
+CHUNK_SIZE = 64 * 1024
+# Default write buffer limits of the transport. Responses are written
+# without waiting for the client until the buffer is above the high-water
+# mark, which bounds the memory held for a slow client.
+WRITE_BUFFER_HIGH = 256 * 1024
+WRITE_BUFFER_LOW = 64 * 1024
+# Default size from which RETR bodies are encoded by a MessageEncoder
+# instead of on the event loop, which takes about 10 ms per megabyte.
+OFFLOAD_THRESHOLD = 1024 * 1024
+# Longest command line accepted, including CRLF. RFC 2449 limits commands
+# to 255 octets; the margin is for long passwords.
+MAX_LINE_LENGTH = 1024
+# Responses common enough to be encoded once.
+RESPONSES = {status: (status + '\r\n').encode('ascii') for status in (
+    '+OK',
+    '+OK Bye',
+    '+OK deleted',
+    '+OK message follows',
+    '+OK name is a valid mailbox',
+    '+OK remote login successful',
+    '+OK scan listing follows',
+    '+OK unique-id listing follows',
+    '-ERR no such message',
+    '-ERR Error: bad syntax',
+)}
+
+
+def dot_stuff(data):
+    """Encode *data* as a POP3 multi-line response body (RFC 1939, 3).
+
+    Returns the buffers (head, body, tail) to send in turn: the body with
+    leading dots doubled, a leading dot for its first line if needed, and
+    the terminating ".CRLF". They are kept apart so that the body is not
+    copied again to add the head and tail.
+    """
+    # bytes.replace() returns *data* itself if there is nothing to stuff.
+    body = data.replace(b'\r\n.', b'\r\n..')
+    head = b'.' if body.startswith(b'.') else b''
+    if not body or body.endswith(b'\r\n'):
+        tail = b'.\r\n'
+    else:
+        tail = b'\r\n.\r\n'
+    return head, body, tail
+
+
+def encode_message(data):
+    """Encode the message *data* as a RETR response body.
+
+    Bare LF line endings, which some IMAP servers return, are changed to
+    CRLF before the body is stuffed by dot_stuff().
+    """
+    if data.count(b'\n') != data.count(b'\r\n'):
+        data = data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    return dot_stuff(data)
 
 
 def command(state):
@@ -17,10 +77,27 @@ def command(state):
     return decorator
 
 
+def _command_table(cls):
+    """Map each command name to its pop3_* method and required state."""
+    table = {}
+    for name in dir(cls):
+        if name.startswith('pop3_'):
+            method = getattr(cls, name)
+            table[name[len('pop3_'):].encode('ascii')] = (
+                method, getattr(method, 'command_state', None))
+    return table
+
+
 class Pop3(asyncio.StreamReaderProtocol):
     __ident__ = 'aiopopd'
 
-    def __init__(self, handler, *, hostname=None, loop=None):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._commands = _command_table(cls)
+
+    def __init__(self, handler, *, hostname=None, loop=None,
+                 write_buffer_high=WRITE_BUFFER_HIGH,
+                 write_buffer_low=WRITE_BUFFER_LOW, encoder=None):
         self.hostname = hostname or socket.getfqdn()
         self.loop = loop or asyncio.get_event_loop()
         super().__init__(
@@ -28,6 +105,20 @@ class Pop3(asyncio.StreamReaderProtocol):
             client_connected_cb=self._client_connected_cb,
             loop=self.loop)
         self.event_handler = handler
+        self.write_buffer_high = write_buffer_high
+        self.write_buffer_low = write_buffer_low
+        # An aiopopd.encoder.MessageEncoder for large messages, or None.
+        self.encoder = encoder
+        self._shutting_down = False
+        self.trace = None
+        # Responses queued by _write() until the session task yields.
+        self._output = []
+        self._output_size = 0
+        self._flush_handle = None
+        self.bytes_sent = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.peak_buffered = 0
 
     async def _call_handler_hook(self, command, *args):
         hook = getattr(self.event_handler, 'handle_' + command, None)
@@ -43,9 +134,16 @@ class Pop3(asyncio.StreamReaderProtocol):
         except (ValueError, TypeError):
             self.peer_str = str(self.peer)
         self.username = self.password = None
+        self.trace = tracer.start_trace(self.peer_str)
+        transport.set_write_buffer_limits(high=self.write_buffer_high,
+                                          low=self.write_buffer_low)
         super().connection_made(transport)
         self.transport = transport
-        log.debug('%s Connection opened', self.peer_str)
+        if self.trace is not None:
+            log.debug('%s Connection opened, trace %s', self.peer_str,
+                      self.trace.trace_id)
+        else:
+            log.debug('%s Connection opened', self.peer_str)
         self._handler_coroutine = self.loop.create_task(
             self._handle_client())
 
@@ -54,7 +152,23 @@ class Pop3(asyncio.StreamReaderProtocol):
         super().connection_lost(error)
         self._handler_coroutine.cancel()
         self.transport = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
         self.event_handler.connection_lost()
+        log.debug('%s Sent %s bytes, peak buffer %s bytes, '
+                  '%s stall(s) for %.3fs', self.peer_str, self.bytes_sent,
+                  self.peak_buffered, self.stalls, self.stall_time)
+        metrics.add('aiopopd_sent_bytes_total', self.bytes_sent)
+        metrics.add('aiopopd_write_stalls_total', self.stalls)
+        metrics.add('aiopopd_write_stall_seconds_total', self.stall_time)
+        if self.trace is not None:
+            if self.username is not None:
+                self.trace.root.attributes['pop3.user'] = self.username
+            root = self.trace.root.attributes
+            root['pop3.peak_buffered_bytes'] = self.peak_buffered
+            root['pop3.stall_ms'] = self.stall_time * 1e3
+            tracer.finish(self.trace)
 
     def eof_received(self):
         log.debug('%s EOF received', self.peer_str)
@@ -65,25 +179,128 @@ class Pop3(asyncio.StreamReaderProtocol):
         self._reader = reader
         self._writer = writer
 
+    def _write(self, data):
+        """Queue *data* to be sent once the session task yields.
+
+        Responses to pipelined commands are read and answered without
+        yielding, so they go out together in one write.
+        """
+        self._output.append(data)
+        self._output_size += len(data)
+        self._sent(len(data))
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        """Hand the queued responses to the transport."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._output:
+            return
+        if len(self._output) == 1:
+            data = self._output[0]
+        else:
+            data = b''.join(self._output)
+        self._output.clear()
+        self._output_size = 0
+        self._writer.write(data)
+
+    def _buffered(self):
+        buffered = (self._writer.transport.get_write_buffer_size() +
+                    self._output_size)
+        if buffered > self.peak_buffered:
+            self.peak_buffered = buffered
+        return buffered
+
+    async def _drain(self):
+        """Flush, and wait for the client if the buffer is too full."""
+        self._flush()
+        if self._buffered() <= self.write_buffer_high:
+            return
+        t = time.perf_counter()
+        await self._writer.drain()
+        self.stalls += 1
+        self.stall_time += time.perf_counter() - t
+
     async def push(self, status):
         log.debug('%s %r', self.peer_str, status)
-        response = (status + '\r\n').encode('ascii')
-        self._writer.write(response)
-        await self._writer.drain()
+        response = RESPONSES.get(status)
+        if response is None:
+            response = (status + '\r\n').encode('ascii')
+        self._write(response)
+        if self._buffered() > self.write_buffer_high:
+            await self._drain()
 
     async def push_multi(self, status, data):
-        await self.push(status)
         if isinstance(data, list):
-            data = b'\r\n'.join(data)
-        lines = data.split(b'\r\n') if data else []
-        log.debug('%s (%s lines)', self.peer_str, len(lines))
-        for line in lines:
-            if line.startswith(b'.'):
-                line = b'.' + line
-            response = line + b'\r\n'
-            self._writer.write(response)
-            await self._writer.drain()
-        await self.push('.')
+            data = b''.join(line + b'\r\n' for line in data)
+        await self.push_stuffed(status, dot_stuff(data))
+
+    async def push_stuffed(self, status, parts):
+        """Send *status* followed by a body encoded by dot_stuff()."""
+        await self.push(status)
+        head, body, tail = parts
+        size = len(head) + len(body) + len(tail)
+        log.debug('%s (%s bytes)', self.peer_str, size)
+        if size <= CHUNK_SIZE:
+            # Small bodies, such as scan listings, are sent with the status.
+            for part in parts:
+                if part:
+                    self._write(part)
+            if self._buffered() > self.write_buffer_high:
+                await self._drain()
+            return
+        self._flush()
+        self._sent(size)
+        if head:
+            self._writer.write(head)
+        view = memoryview(body)
+        for i in range(0, len(view), CHUNK_SIZE):
+            self._writer.write(view[i:i + CHUNK_SIZE])
+            await self._drain()
+        self._writer.write(tail)
+        await self._drain()
+
+    async def push_message(self, status, data):
+        """Send *status* followed by the message *data* for RETR.
+
+        Messages at or above the encoder's threshold are encoded in its
+        worker processes and sent from a file, so that encoding them does
+        not block the other sessions.
+        """
+        if self.encoder is None or len(data) < self.encoder.threshold:
+            await self.push_stuffed(status, encode_message(data))
+            return
+        fp = await self.encoder.encode(data, self.loop)
+        if fp is None:
+            await self.push_stuffed(status, encode_message(data))
+            return
+        try:
+            await self.push_file(status, fp)
+        finally:
+            # The file is already unlinked, and freeing its pages on the
+            # last close takes milliseconds for a large message.
+            self.loop.run_in_executor(None, fp.close)
+
+    async def push_file(self, status, fp):
+        """Send *status* followed by a dot-stuffed body stored in *fp*.
+
+        Plain TCP transports use os.sendfile(); TLS transports fall back to
+        reading and writing the file in chunks.
+        """
+        await self.push(status)
+        self._flush()
+        n = await self.loop.sendfile(self.transport, fp)
+        log.debug('%s (%s bytes from file)', self.peer_str, n)
+        self._sent(n)
+
+    def _sent(self, n):
+        self.bytes_sent += n
+        if self.trace is not None:
+            span = current_span.get()
+            if span is not None:
+                span.add('pop3.bytes_sent', n)
 
     async def handle_exception(self, error):
         if hasattr(self.event_handler, 'handle_exception'):
@@ -99,31 +316,47 @@ class Pop3(asyncio.StreamReaderProtocol):
         try:
             self.state = 'AUTHORIZATION'
             await self.push('+OK {} {}'.format(self.hostname, self.__ident__))
+            commands = self._commands
             while self.transport is not None:
-                line = await self._reader.readline()
-                log.debug('%s %s', self.peer_str, line.split()[0])
-                line = line.rstrip(b'\r\n')
-                if not line:
-                    await self.push('-ERR Error: bad syntax')
-                    continue
-                line = line.decode('ascii')
                 try:
-                    command, arg = line.split(' ', 1)
+                    line = await self._reader.readline()
                 except ValueError:
-                    command, arg = line, None
-                method = getattr(self, 'pop3_' + command, None)
-                method_state = getattr(method, 'command_state', None)
-                if method_state is not None and method_state != self.state:
-                    await self.push(
-                        '-ERR wrong state for "%s"' % command)
+                    # Longer than the reader's limit, which drops it.
+                    line = None
+                if line is None or len(line) > MAX_LINE_LENGTH:
+                    await self.push('-ERR line too long')
+                    self._flush()
+                    self.transport.close()
+                    return
+                command, space, arg = line.rstrip(b'\r\n').partition(b' ')
+                log.debug('%s %s', self.peer_str, command)
+                if not command:
+                    await self.push('-ERR Error: bad syntax')
                     continue
+                method, method_state = commands.get(command, (None, None))
                 if method is None:
-                    await self.push(
-                        '-ERR command "%s" not recognized' % command)
+                    await self.push('-ERR command "%s" not recognized' %
+                                    command.decode('ascii', 'backslashreplace'))
+                    continue
+                if method_state is not None and method_state != self.state:
+                    await self.push('-ERR wrong state for "%s"' %
+                                    command.decode('ascii'))
                     continue
-                await method(arg)
+                arg = arg.decode('ascii') if space else None
+                if self.trace is None:
+                    await method(self, arg)
+                    continue
+                span = self.trace.start_command(command.decode('ascii'))
+                token = current_span.set(span)
+                try:
+                    await method(self, arg)
+                finally:
+                    current_span.reset(token)
+                    span.end = time.time_ns()
         except asyncio.CancelledError:
-            self._writer.close()
+            if not self._shutting_down:
+                self._flush()
+                self._writer.close()
         except Exception as error:
             try:
                 status = await self.handle_exception(error)
@@ -135,6 +368,31 @@ class Pop3(asyncio.StreamReaderProtocol):
                 except Exception:
                     status = '-ERR Error: Cannot describe error'
             await self.push(status)
+            # The command loop has ended, so don't leave the client waiting.
+            if self.transport is not None:
+                self._flush()
+                self.transport.close()
+
+    async def shutdown(self):
+        """End the session, committing DELEs as if the client sent QUIT."""
+        self._shutting_down = True
+        self._handler_coroutine.cancel()
+        try:
+            await self._handler_coroutine
+        except asyncio.CancelledError:
+            pass
+        if getattr(self, 'state', None) == 'TRANSACTION':
+            log.info('%s Committing session of %r on shutdown',
+                     self.peer_str, self.username)
+            try:
+                await self._call_handler_hook('QUIT')
+            except Exception:
+                log.exception('%s Exception while committing session',
+                              self.peer_str)
+            self.state = 'UPDATE'
+        if self.transport is not None:
+            self._flush()
+            self.transport.close()
 
     @staticmethod
     def parse_message_number(arg):
@@ -209,6 +467,7 @@ class Pop3(asyncio.StreamReaderProtocol):
             return
         status = await self._call_handler_hook('QUIT')
         await self.push('+OK Bye' if status is MISSING else status)
+        self._flush()
         self._handler_coroutine.cancel()
         self.transport.close()
 
@@ -347,3 +606,6 @@ class Pop3(asyncio.StreamReaderProtocol):
         status = await self._call_handler_hook('TOP', n, lines)
         if status is MISSING:
             await self.push('-ERR TOP not implemented')
+
+
+Pop3._commands = _command_table(Pop3)
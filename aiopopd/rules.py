@@ -0,0 +1,71 @@
+import time
+import fnmatch
+
+
+# Deferred messages are presented anyway after this many listings in a row
+# that held them back, so a steady stream of new mail cannot postpone them
+# forever.
+MAX_DEFER_POLLS = 10
+
+class Rule:
+    """Skip or defer messages by sender, size or age, decided at listing time.
+
+    A rule matches when all of its conditions match. "skip" hides the
+    message from POP3; "defer" presents it only once no other messages
+    are waiting, so a large backlog is spread over several polls.
+    """
+
+    ACTIONS = ('skip', 'defer')
+
+    def __init__(self, action, sender=None, larger_than=None,
+                 older_than_days=None):
+        if action not in self.ACTIONS:
+            raise ValueError('unknown rule action %r' % (action,))
+        self.action = action
+        self.sender = sender.lower() if sender is not None else None
+        self.larger_than = larger_than
+        self.older_than_days = older_than_days
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config)
+
+    @property
+    def needs_headers(self):
+        return self.sender is not None or self.older_than_days is not None
+
+    def matches(self, message, now):
+        if self.sender is not None:
+            if not fnmatch.fnmatchcase(message.sender or '', self.sender):
+                return False
+        if self.larger_than is not None:
+            if message.size <= self.larger_than:
+                return False
+        if self.older_than_days is not None:
+            if message.date is None:
+                return False
+            if now - message.date < self.older_than_days * 86400:
+                return False
+        return True
+
+
+def apply_rules(rules, messages, present_deferred=False):
+    """Return (presented, deferred, skipped) according to the first match.
+
+    With *present_deferred*, messages that match a defer rule are presented
+    along with the others.
+    """
+    now = time.time()
+    result = dict(present=[], defer=[], skip=[])
+    for m in messages:
+        action = 'present'
+        for rule in rules:
+            if rule.matches(m, now):
+                action = rule.action
+                break
+        if action == 'defer' and present_deferred:
+            action = 'present'
+        result[action].append(m)
+    presented = result['present'] or result['defer']
+    deferred = result['defer'] if result['present'] else []
+    return presented, deferred, result['skip']
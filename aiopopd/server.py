@@ -1,33 +1,123 @@
 import os
+import sys
 import json
-import time
+import signal
 import logging
+import asyncio
 import argparse
-from aiopopd.pop import Pop3
-from aiopopd.imap import ImapHandler, ImapBackend
-from aiopopd.controller import Controller
+import threading
+from aiopopd.pop import (
+    Pop3, log, WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW, OFFLOAD_THRESHOLD)
+from aiopopd.imap import ImapHandler, ImapBackend, CredentialCache, Maildrops
+from aiopopd.rules import Rule
+from aiopopd.limiter import UpstreamLimits
+from aiopopd.metrics import metrics
+from aiopopd.tracing import tracer
+from aiopopd.controller import (
+    Controller, inherited_socket, notify_ready, sd_notify)
 from aiopopd.main import get_ssl_context, SystemdFormatter
 
 
+class AccountDirectory:
+    """In-memory copy of the account files in *path*.
+
+    The directory is polled every *interval* seconds; only files whose
+    mtime or size changed are parsed again.
+    """
+
+    def __init__(self, path, *, interval=5):
+        self.path = path
+        self.interval = interval
+        self.accounts = {}
+        self._stat = {}
+
+    def get(self, username):
+        return self.accounts.get(username)
+
+    def reload(self):
+        accounts = dict(self.accounts)
+        seen = set()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                seen.add(entry.name)
+                st = entry.stat()
+                key = (st.st_mtime_ns, st.st_size)
+                if self._stat.get(entry.name) == key:
+                    continue
+                self._stat[entry.name] = key
+                try:
+                    with open(entry.path) as fp:
+                        config = json.load(fp)
+                    # Reject bad rules now rather than at the next login.
+                    for rule in config.get('rules', []):
+                        Rule.from_config(rule)
+                    accounts[entry.name] = config
+                except (OSError, ValueError, TypeError,
+                        AttributeError) as exn:
+                    log.warning('Cannot load account %r: %s', entry.name, exn)
+                    accounts.pop(entry.name, None)
+                    continue
+                log.info('Loaded account %r', entry.name)
+        for name in set(self._stat) - seen:
+            log.info('Removed account %r', name)
+            del self._stat[name]
+            accounts.pop(name, None)
+        # Replace the dict in one step, since reload() runs in a worker
+        # thread while get() is called from the event loop.
+        self.accounts = accounts
+
+    async def watch(self, loop):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await loop.run_in_executor(None, self.reload)
+            except Exception:
+                log.exception('Reloading accounts from %r failed', self.path)
+
+
 class ImapHandlerFile(ImapHandler):
-    def __init__(self, path, **kwargs):
+    def __init__(self, accounts, **kwargs):
         super().__init__(**kwargs)
-        self.path = path
+        self.accounts = accounts
+
+    def known_account(self, username):
+        return self.accounts.get(username) is not None
 
     async def get_backend(self, username, password):
-        if '/' in username or username.startswith('.'):
-            raise ValueError('invalid username')
-        try:
-            with open(os.path.join(self.path, username)) as fp:
-                config = json.load(fp)
-        except FileNotFoundError:
+        # Unknown usernames are rejected without touching the disk, since
+        # the whole directory is kept in memory.
+        config = self.accounts.get(username)
+        if config is None:
             raise ValueError('unknown username')
         backend = ImapBackend(loop=self.loop, host=config['hostname'],
-                              port=config['port'], ssl=config.get('ssl', True))
-        await backend.connect()
-        await backend.login(config.get('username', username), password)
+                              port=config['port'], ssl=config.get('ssl', True),
+                              limiter=self.get_limiter(config['hostname']),
+                              account=username)
+        try:
+            await backend.connect()
+            await backend.login(config.get('username', username), password)
+        except BaseException:
+            backend.connection_lost()
+            raise
         return backend
 
+    def get_folders(self, username):
+        return self.accounts.get(username).get('folders', ['INBOX'])
+
+    def get_rules(self, username):
+        return [Rule.from_config(rule)
+                for rule in self.accounts.get(username).get('rules', [])]
+
+    def get_window(self, username):
+        config = self.accounts.get(username)
+        return (config.get('window_messages', self.max_messages),
+                config.get('window_bytes', self.max_bytes))
+
+    def get_gmail_query(self, username):
+        return self.accounts.get(username).get('gmail_query', 'is:unread')
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--path', required=True)
@@ -39,6 +129,28 @@ parser.add_argument('-d', '--hostname')
 parser.add_argument('--ssl-key')
 parser.add_argument('--ssl-cert')
 parser.add_argument('--ssl-generate', action='store_true')
+parser.add_argument('--drain-timeout', type=float, default=30)
+parser.add_argument('--reload-interval', type=float, default=5)
+parser.add_argument('--state')
+parser.add_argument('--metrics')
+parser.add_argument('--window-messages', type=int)
+parser.add_argument('--window-bytes', type=int)
+parser.add_argument('--metrics-interval', type=float, default=15)
+parser.add_argument('--write-buffer-high', type=int,
+                    default=WRITE_BUFFER_HIGH)
+parser.add_argument('--write-buffer-low', type=int, default=WRITE_BUFFER_LOW)
+parser.add_argument('--snapshot')
+parser.add_argument('--snapshot-interval', type=float, default=60)
+parser.add_argument('--offload-threshold', type=int,
+                    default=OFFLOAD_THRESHOLD)
+parser.add_argument('--offload-workers', type=int, default=2)
+parser.add_argument('--upstream-concurrency', type=int, default=4)
+parser.add_argument('--upstream-max-concurrency', type=int, default=32)
+parser.add_argument('--upstream-max-connections', type=int, default=64)
+parser.add_argument('--trace')
+parser.add_argument('--trace-sample-rate', type=float, default=0.01)
+parser.add_argument('--trace-slow', type=float, default=1.0)
+parser.add_argument('--trace-max-bytes', type=int, default=10 * 1024 * 1024)
 
 
 def main():
@@ -52,12 +164,51 @@ def main():
         handler, = logging.getLogger().handlers
         handler.setFormatter(SystemdFormatter())
 
+    if args.trace:
+        tracer.configure(args.trace, sample_rate=args.trace_sample_rate,
+                         slow_threshold=args.trace_slow,
+                         max_bytes=args.trace_max_bytes)
+
+    accounts = AccountDirectory(args.path, interval=args.reload_interval)
+    accounts.reload()
+
+    credential_cache = CredentialCache()
+    maildrops = Maildrops()
+    limits = UpstreamLimits(initial=args.upstream_concurrency,
+                            maximum=args.upstream_max_concurrency,
+                            max_connections=args.upstream_max_connections)
+    store = None
+    snapshot = None
+    if args.snapshot:
+        from aiopopd.snapshot import MailboxSnapshot
+
+        snapshot = MailboxSnapshot(args.snapshot)
+    encoder = None
+    if args.offload_workers:
+        from aiopopd.encoder import MessageEncoder
+
+        encoder = MessageEncoder(threshold=args.offload_threshold,
+                                 workers=args.offload_workers)
+
     def factory():
-        return Pop3(ImapHandlerFile(args.path), hostname=args.hostname)
+        handler = ImapHandlerFile(accounts, credential_cache=credential_cache,
+                                  store=store, maildrops=maildrops,
+                                  snapshot=snapshot, limits=limits,
+                                  max_messages=args.window_messages,
+                                  max_bytes=args.window_bytes)
+        return Pop3(handler, hostname=args.hostname,
+                    write_buffer_high=args.write_buffer_high,
+                    write_buffer_low=args.write_buffer_low,
+                    encoder=encoder)
 
     hostname = '0.0.0.0' if args.listen_all else '::1'
     controller = Controller(None, hostname=hostname, port=args.listen_port,
-                            ssl_context=ssl_context, setuid=args.setuid)
+                            ssl_context=ssl_context, setuid=args.setuid,
+                            sock=inherited_socket())
+    if args.state:
+        from aiopopd.store import StateStore
+
+        store = StateStore(args.state, loop=controller.loop)
     controller.factory = factory
     controller.loop.set_debug(enabled=True)
     try:
@@ -65,12 +216,67 @@ def main():
     except PermissionError:
         raise SystemExit(
             'Cannot setuid "nobody"; try running with -n option.')
-    try:
-        while True:
-            time.sleep(60)
-    except KeyboardInterrupt:
-        pass
-    controller.stop()
+    notify_ready()
+    asyncio.run_coroutine_threadsafe(
+        accounts.watch(controller.loop), controller.loop)
+    if encoder is not None:
+        encoder.start()
+    if args.metrics:
+        asyncio.run_coroutine_threadsafe(
+            metrics.export(args.metrics, args.metrics_interval),
+            controller.loop)
+    def write_snapshot():
+        try:
+            snapshot.write()
+        except Exception:
+            log.exception('Writing snapshot to %r failed', snapshot.path)
+
+    if snapshot is not None:
+        asyncio.run_coroutine_threadsafe(
+            snapshot.export(args.snapshot_interval, controller.loop),
+            controller.loop)
+
+    # SIGTERM/SIGINT: drain and exit.
+    # SIGHUP: start a new process on the same socket and, once it accepts
+    # connections, drain and exit. If it fails, keep serving.
+    stopping = threading.Event()
+    restart = []
+
+    def on_signal(signum, frame):
+        if signum == signal.SIGHUP:
+            restart.append(signum)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGHUP, on_signal)
+    argv = [sys.executable, '-m', 'aiopopd.server'] + sys.argv[1:]
+    while True:
+        try:
+            # The kernel may deliver the signal to the event loop thread,
+            # and Python only runs the handler once the main thread wakes.
+            while not stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            restart.clear()
+        stopping.clear()
+        if not restart:
+            sd_notify('STOPPING=1')
+            break
+        restart.clear()
+        if args.ssl_key and not os.access(args.ssl_key, os.R_OK):
+            # After setuid, the new process could not load the TLS key.
+            log.error('Not restarting: %r is not readable by this process',
+                      args.ssl_key)
+            continue
+        if snapshot is not None:
+            write_snapshot()
+        if controller.handover(argv) is not None:
+            break
+    controller.drain(args.drain_timeout)
+    if snapshot is not None:
+        write_snapshot()
+    if encoder is not None:
+        encoder.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,215 @@
+import os
+import mmap
+import math
+import struct
+import asyncio
+import threading
+
+from aiopopd.pop import log
+
+
+# File layout, all little-endian:
+#   header     magic, version, number of folders
+#   directory  one ENTRY per folder, each followed by "account\0folder"
+#   folders    for each folder, its RECORDs and then the senders, each a
+#              u16 length and UTF-8 bytes, that the records point into
+MAGIC = b'APSN'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+# uidvalidity, number of records, length of name, offset, length of data
+ENTRY = struct.Struct('<IIIQQ')
+# uid, size, X-GM-MSGID (0 if none), date (NaN if none), offset of sender
+# (NO_SENDER if none)
+RECORD = struct.Struct('<IIQdI')
+SENDER_LENGTH = struct.Struct('<H')
+NO_SENDER = 0xffffffff
+
+
+def _encode_folder(index):
+    records = []
+    senders = []
+    senders_size = 0
+    for uid, (size, msgid, sender, date) in sorted(index.items()):
+        if sender is None:
+            sender_offset = NO_SENDER
+        else:
+            data = sender.encode('utf-8')[:0xffff]
+            sender_offset = senders_size
+            senders.append(SENDER_LENGTH.pack(len(data)))
+            senders.append(data)
+            senders_size += SENDER_LENGTH.size + len(data)
+        records.append(RECORD.pack(
+            uid, size, msgid or 0, math.nan if date is None else date,
+            sender_offset))
+    return b''.join(records + senders)
+
+
+def _decode_folder(data, count):
+    senders = data[count * RECORD.size:]
+    index = {}
+    for uid, size, msgid, date, sender_offset in RECORD.iter_unpack(
+            data[:count * RECORD.size]):
+        if sender_offset == NO_SENDER:
+            sender = None
+        else:
+            n, = SENDER_LENGTH.unpack_from(senders, sender_offset)
+            start = sender_offset + SENDER_LENGTH.size
+            sender = str(senders[start:start + n], 'utf-8')
+        index[uid] = (size, msgid or None, sender,
+                      None if math.isnan(date) else date)
+    return index
+
+
+class MailboxSnapshot:
+    """The message index of each account, kept in memory and checkpointed
+    to a binary file.
+
+    The index has the same contents as the one in StateStore: the UIDs,
+    sizes and rule headers of the unseen messages of each folder, valid
+    for one UIDVALIDITY. After a restart the file is memory-mapped, and a
+    folder is only decoded when its account first logs in, so logins
+    fetch the details of new messages only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._folders = {}
+        self._map = None
+        self._directory = None
+        self._dirty = False
+        # write() runs from export() and from the main thread on SIGHUP
+        # and at exit.
+        self._write_lock = threading.Lock()
+
+    def _load(self):
+        self._map, self._directory = self._open()
+
+    def _open(self):
+        directory = {}
+        try:
+            fp = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None, directory
+        with fp:
+            if os.fstat(fp.fileno()).st_size < HEADER.size:
+                return None, directory
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        with memoryview(mapped) as view:
+            magic, version, n = HEADER.unpack_from(view)
+            if magic != MAGIC or version != VERSION:
+                log.warning('Ignoring snapshot %r of unknown format',
+                            self.path)
+                return None, directory
+            try:
+                pos = HEADER.size
+                for _ in range(n):
+                    uidvalidity, count, name_length, offset, length = (
+                        ENTRY.unpack_from(view, pos))
+                    pos += ENTRY.size
+                    account, folder = str(view[pos:pos + name_length],
+                                          'utf-8').split('\0')
+                    pos += name_length
+                    if (offset + length > len(view) or
+                            count * RECORD.size > length):
+                        raise ValueError('folder data out of range')
+                    directory[account, folder] = (
+                        uidvalidity, count, offset, length)
+            except (struct.error, ValueError) as exn:
+                # Truncated or damaged, e.g. by a crash during a write
+                # without the fsync. Start over rather than fail every get().
+                log.warning('Ignoring damaged snapshot %r: %s',
+                            self.path, exn)
+                return None, {}
+        return mapped, directory
+
+    def get(self, account, folder, uidvalidity):
+        """Return {uid: (size, msgid, sender, date)} for *uidvalidity*."""
+        key = account, folder
+        try:
+            known_uidvalidity, index = self._folders[key]
+        except KeyError:
+            if self._directory is None:
+                self._load()
+            try:
+                known_uidvalidity, count, offset, length = (
+                    self._directory[key])
+            except KeyError:
+                return {}
+            try:
+                index = _decode_folder(
+                    memoryview(self._map)[offset:offset + length], count)
+            except (struct.error, ValueError) as exn:
+                log.warning('Ignoring damaged snapshot of %r %r: %s',
+                            account, folder, exn)
+                index = {}
+            self._folders[key] = known_uidvalidity, index
+        if known_uidvalidity != uidvalidity:
+            return {}
+        return index
+
+    def put(self, account, folder, uidvalidity, messages):
+        self._folders[account, folder] = uidvalidity, {
+            m.uid: (m.size, m.msgid, m.sender, m.date) for m in messages}
+        self._dirty = True
+
+    def write(self):
+        """Write the snapshot file, replacing it atomically.
+
+        May run in another thread than put() and get(), since put()
+        replaces the index of a folder instead of changing it.
+        """
+        with self._write_lock:
+            self._dirty = False
+            try:
+                self._write()
+            except BaseException:
+                self._dirty = True
+                raise
+
+    def _write(self):
+        if self._directory is None:
+            self._load()
+        decoded = dict(self._folders)
+        folders = []
+        for key, (uidvalidity, index) in decoded.items():
+            folders.append((key, uidvalidity, len(index),
+                            _encode_folder(index)))
+        for key, (uidvalidity, count, offset, length) in (
+                self._directory.items()):
+            if key not in decoded:
+                # Never looked up since the restart, so copy it as is.
+                folders.append((key, uidvalidity, count,
+                                self._map[offset:offset + length]))
+        names = [('%s\0%s' % key).encode('utf-8') for key, *_ in folders]
+        offset = HEADER.size + sum(ENTRY.size + len(name) for name in names)
+        parts = [HEADER.pack(MAGIC, VERSION, len(folders))]
+        for name, (key, uidvalidity, count, data) in zip(names, folders):
+            parts.append(ENTRY.pack(uidvalidity, count, len(name), offset,
+                                    len(data)))
+            parts.append(name)
+            offset += len(data)
+        parts.extend(data for *_, data in folders)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.writelines(parts)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.path)
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    async def export(self, interval, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        if self._directory is None:
+            self._load()
+        while True:
+            await asyncio.sleep(interval)
+            if not self._dirty:
+                continue
+            try:
+                await loop.run_in_executor(None, self.write)
+            except Exception:
+                log.exception('Writing snapshot to %r failed', self.path)
@@ -0,0 +1,186 @@
+import sqlite3
+import asyncio
+import concurrent.futures
+
+from aiopopd.pop import log
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pending (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    uidvalidity INTEGER,
+    PRIMARY KEY (account, folder, uid)
+);
+CREATE TABLE IF NOT EXISTS folders (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    PRIMARY KEY (account, folder)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    msgid INTEGER,
+    sender TEXT,
+    date REAL,
+    PRIMARY KEY (account, folder, uid)
+);
+CREATE TABLE IF NOT EXISTS retrieved (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    PRIMARY KEY (account, folder, uid)
+);
+'''
+
+
+class StateStore:
+    """POP3 state that must survive a crash or restart, kept in SQLite.
+
+    *pending* holds messages the client deleted whose \\Seen flag has not
+    been set upstream yet; they are flagged on the account's next login,
+    if the folder still has the UIDVALIDITY they were deleted under.
+    *messages* is the index of unseen messages per folder, so a listing
+    only needs to fetch the sizes (and the headers used by rules) of
+    messages it has not seen before. *retrieved* holds the messages of
+    the index that a client has retrieved, so that a session window can
+    move past them when the client leaves them on the server.
+
+    Writes are queued and committed together, at most *commit_interval*
+    seconds after the first one, by the thread that owns the connection.
+    """
+
+    def __init__(self, path, *, loop=None, commit_interval=0.5):
+        self.path = path
+        self.loop = loop or asyncio.get_event_loop()
+        self.commit_interval = commit_interval
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._db = None
+        self._writes = []
+        self._flush_handle = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(SCHEMA)
+            for table, column, type_ in (('messages', 'sender', 'TEXT'),
+                                         ('messages', 'date', 'REAL'),
+                                         ('pending', 'uidvalidity',
+                                          'INTEGER')):
+                columns = [row[1] for row in self._db.execute(
+                    'PRAGMA table_info(%s)' % table)]
+                if column not in columns:
+                    # Rows from before the column are NULL, which never
+                    # matches, so pending deletions of them are dropped.
+                    self._db.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                                     % (table, column, type_))
+        return self._db
+
+    async def _run(self, fn, *args):
+        return await self.loop.run_in_executor(self._executor, fn, *args)
+
+    def _write(self, sql, rows):
+        self._writes.append((sql, rows))
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(
+                self.commit_interval, self._flush_soon)
+
+    def _flush_soon(self):
+        self._flush_handle = None
+        self.loop.create_task(self.flush())
+
+    async def flush(self):
+        """Commit the queued writes in one transaction."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        writes, self._writes = self._writes, []
+        if writes:
+            await self._run(self._commit, writes)
+
+    def _commit(self, writes):
+        db = self._connect()
+        try:
+            with db:
+                for sql, rows in writes:
+                    db.executemany(sql, rows)
+        except sqlite3.Error:
+            log.exception('Committing %s write(s) to %r failed',
+                          len(writes), self.path)
+
+    def mark_deleted(self, account, folder, uidvalidity, uids):
+        self._write('INSERT OR IGNORE INTO pending VALUES (?, ?, ?, ?)',
+                    [(account, folder, uid, uidvalidity) for uid in uids])
+
+    def unmark_deleted(self, account, folder, uids):
+        self._write(
+            'DELETE FROM pending WHERE account = ? AND folder = ? AND uid = ?',
+            [(account, folder, uid) for uid in uids])
+
+    async def get_deleted(self, account):
+        """Return {folder: [(uidvalidity, uid), ...]} of flag updates left
+        by a crash."""
+        await self.flush()
+        rows = await self._run(
+            self._query,
+            'SELECT folder, uidvalidity, uid FROM pending WHERE account = ?',
+            (account,))
+        result = {}
+        for folder, uidvalidity, uid in rows:
+            result.setdefault(folder, []).append((uidvalidity, uid))
+        return result
+
+    def mark_retrieved(self, account, folder, uidvalidity, uids):
+        self._write('INSERT OR REPLACE INTO retrieved VALUES (?, ?, ?, ?)',
+                    [(account, folder, uid, uidvalidity) for uid in uids])
+
+    async def get_retrieved(self, account):
+        """Return {(folder, uidvalidity, uid), ...} of retrieved messages."""
+        await self.flush()
+        rows = await self._run(
+            self._query,
+            'SELECT folder, uidvalidity, uid FROM retrieved '
+            'WHERE account = ?', (account,))
+        return set(rows)
+
+    def _query(self, sql, params):
+        return self._connect().execute(sql, params).fetchall()
+
+    async def get_index(self, account, folder, uidvalidity):
+        """Return {uid: (size, msgid, sender, date)} of the last listing."""
+        rows = await self._run(self._get_index, account, folder, uidvalidity)
+        return {row[0]: row[1:] for row in rows}
+
+    def _get_index(self, account, folder, uidvalidity):
+        db = self._connect()
+        row = db.execute(
+            'SELECT uidvalidity FROM folders WHERE account = ? AND folder = ?',
+            (account, folder)).fetchone()
+        if row is None or row[0] != uidvalidity:
+            return []
+        return db.execute(
+            'SELECT uid, size, msgid, sender, date FROM messages '
+            'WHERE account = ? AND folder = ?', (account, folder)).fetchall()
+
+    def put_index(self, account, folder, uidvalidity, messages):
+        self._write('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)',
+                    [(account, folder, uidvalidity)])
+        self._write('DELETE FROM messages WHERE account = ? AND folder = ?',
+                    [(account, folder)])
+        self._write('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(account, folder, m.uid, m.size, m.msgid, m.sender,
+                      m.date)
+                     for m in messages])
+        # Retrieved messages no longer in the index were deleted or seen.
+        self._write(
+            'DELETE FROM retrieved WHERE account = ? AND folder = ? AND '
+            '(uidvalidity != ? OR uid NOT IN (SELECT uid FROM messages '
+            'WHERE account = ? AND folder = ?))',
+            [(account, folder, uidvalidity, account, folder)])
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import random
+import logging
+import contextvars
+
+
+# The command span of the POP3 session running in the current task. Tasks
+# started by a command (such as the mailbox scan started by PASS) inherit
+# it, so the IMAP calls they make are recorded under that command.
+current_span = contextvars.ContextVar('current_span', default=None)
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent', 'name', 'kind', 'start',
+                 'end', 'attributes')
+
+    def __init__(self, trace, name, kind, parent=None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = {}
+
+    def add(self, key, value):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    @property
+    def duration(self):
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def to_otlp(self, trace_id):
+        span = {
+            'traceId': trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end or time.time_ns()),
+            'attributes': [{'key': k, 'value': _otlp_value(v)}
+                           for k, v in self.attributes.items()],
+        }
+        if self.parent is not None:
+            span['parentSpanId'] = self.parent.span_id
+        return span
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class ImapCall:
+    """Timestamps of one IMAP command, set by the backend worker thread."""
+
+    __slots__ = ('span', 'started', 'finished', 'response_bytes')
+
+    def __init__(self, span):
+        self.span = span
+        self.started = self.finished = None
+        self.response_bytes = 0
+
+    def done(self):
+        span = self.span
+        span.end = time.time_ns()
+        # When the caller was cancelled, the worker may still be running
+        # the command. It sets started before finished, so read them in the
+        # other order.
+        finished = self.finished
+        started = self.started
+        if started is not None:
+            span.attributes['imap.queue_wait_ms'] = (
+                (started - span.start) / 1e6)
+        if finished is not None:
+            span.attributes['imap.server_ms'] = (finished - started) / 1e6
+            span.attributes['imap.response_bytes'] = self.response_bytes
+        parent = span.parent
+        if parent is not None:
+            parent.add('imap.calls', 1)
+            parent.add('imap.response_bytes', self.response_bytes)
+
+
+class Trace:
+    """The spans of one POP3 session: the session, its commands, and the
+    IMAP commands each of them caused."""
+
+    def __init__(self, peer):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(self, 'POP3 session', SPAN_KIND_SERVER)
+        self.root.attributes['net.peer.name'] = peer
+        self.spans = [self.root]
+
+    def start_command(self, command):
+        span = Span(self, 'POP3 ' + command, SPAN_KIND_INTERNAL, self.root)
+        self.spans.append(span)
+        return span
+
+    def start_imap_call(self, parent, method):
+        span = Span(self, 'IMAP ' + method, SPAN_KIND_CLIENT, parent)
+        self.spans.append(span)
+        return ImapCall(span)
+
+    def slowest_command(self):
+        return max((span.duration for span in self.spans
+                    if span.kind == SPAN_KIND_INTERNAL), default=0)
+
+    def to_otlp(self):
+        return {'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name',
+                 'value': {'stringValue': 'aiopopd'}}]},
+            'scopeSpans': [{
+                'scope': {'name': 'aiopopd'},
+                'spans': [span.to_otlp(self.trace_id)
+                          for span in self.spans],
+            }],
+        }]}
+
+
+class Tracer:
+    """Record a sample of POP3 sessions and write the slow ones to a file.
+
+    Each line of the file is an OTLP/JSON ExportTraceServiceRequest, as
+    written by the OpenTelemetry collector's file exporter, so it can be
+    replayed into a collector or read by hand.
+    """
+
+    def __init__(self):
+        self.sample_rate = 0
+        self.slow_threshold = 0
+        self._output = None
+
+    def configure(self, path, *, sample_rate=0.01, slow_threshold=1.0,
+                  max_bytes=10 * 1024 * 1024, backup_count=5):
+        import logging.handlers
+
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._output = logging.getLogger('aiopopd.trace')
+        self._output.propagate = False
+        self._output.setLevel(logging.INFO)
+        self._output.addHandler(handler)
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    def start_trace(self, peer):
+        """Return a Trace for a new session, or None if it is not sampled."""
+        if self._output is None or random.random() >= self.sample_rate:
+            return None
+        return Trace(peer)
+
+    def finish(self, trace):
+        trace.root.end = time.time_ns()
+        if trace.slowest_command() < self.slow_threshold:
+            return
+        self._output.info(json.dumps(trace.to_otlp(),
+                                     separators=(',', ':')))
+
+
+def response_size(value):
+    """Approximate the number of bytes in an IMAPClient result."""
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(response_size(k) + response_size(v)
+                   for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(response_size(v) for v in value)
+    return 0
+
+
+tracer = Tracer()
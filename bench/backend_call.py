@@ -0,0 +1,122 @@
+"""Per-call overhead of handing IMAP commands to the backend worker thread.
+
+The IMAP connection is replaced by an in-process fake that answers
+immediately, so the numbers are the cost of the thread handoff alone.
+"pipe" is the queue + pipe + add_reader handoff ImapBackend used before
+it resolved futures directly with call_soon_threadsafe().
+
+Usage: python3 -m bench.backend_call [-n CALLS]
+"""
+import os
+import time
+import queue
+import asyncio
+import argparse
+import threading
+
+from aiopopd.imap_backend import ImapBackend
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--calls', type=int, default=20000)
+
+
+class FakeClient:
+    def noop(self):
+        return (b'NOOP completed', [])
+
+    def get_flags(self, messages):
+        return {uid: (b'\\Seen',) for uid in messages}
+
+    def shutdown(self):
+        pass
+
+
+class DirectBackend(ImapBackend):
+    def _connect(self):
+        self._conn = FakeClient()
+
+
+class PipeBackend:
+    BREAK = object()
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._command_queue = queue.Queue()
+        self._response_queue = queue.Queue()
+        self._ready_r, self._ready_w = os.pipe()
+        self._loop.add_reader(self._ready_r, self._ready)
+        self._thread = threading.Thread(None, self._run)
+        self._thread.start()
+
+    def close(self):
+        self._command_queue.put((None, self.BREAK, ()))
+        self._thread.join()
+        self._loop.remove_reader(self._ready_r)
+        os.close(self._ready_r)
+        os.close(self._ready_w)
+
+    async def _call(self, method, *args):
+        future = self._loop.create_future()
+        self._command_queue.put_nowait((future, method, args))
+        result = await future
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run(self):
+        conn = FakeClient()
+        while True:
+            future, method, args = self._command_queue.get()
+            if method is self.BREAK:
+                break
+            try:
+                result = getattr(conn, method)(*args)
+            except Exception as exn:
+                result = exn
+            self._response_queue.put((future, result))
+            self._command_queue.task_done()
+            os.write(self._ready_w, b'x')
+
+    def _ready(self):
+        os.read(self._ready_r, 1)
+        future, result = self._response_queue.get_nowait()
+        if not future.cancelled():
+            future.set_result(result)
+        self._response_queue.task_done()
+
+
+async def measure(backend, n, method, *args):
+    t = time.perf_counter()
+    for _ in range(n):
+        await backend._call(method, *args)
+    return (time.perf_counter() - t) / n
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    results = []
+    pipe = PipeBackend(loop)
+    direct = DirectBackend(loop, 'localhost', 143, False)
+    await direct.connect()
+    for name, backend in (('pipe', pipe), ('direct', direct)):
+        noop = await measure(backend, args.calls, 'noop')
+        flags = await measure(backend, args.calls, 'get_flags', [1, 2, 3])
+        results.append((name, noop, flags))
+    pipe.close()
+    direct.connection_lost()
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print('%-10s %12s %12s' % ('handoff', 'NOOP', 'FLAGS'))
+    for name, noop, flags in loop.run_until_complete(run(args)):
+        print('%-10s %10.1fus %10.1fus' % (name, noop * 1e6, flags * 1e6))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Time from PASS to the first response byte, and to the STAT reply.
+
+The upstream is simulated by a backend that sleeps for each command, so
+the numbers show how much of the mailbox scan the client waits for.
+
+Usage: python3 -m bench.lazy_pass [-n MESSAGES]
+"""
+import time
+import asyncio
+import argparse
+
+from aiopopd.pop import Pop3
+from aiopopd.imap import ImapHandler
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--messages', type=int, default=20000)
+parser.add_argument('--login-latency', type=float, default=0.1)
+parser.add_argument('--command-latency', type=float, default=0.02)
+parser.add_argument('--fetch-per-message', type=float, default=20e-6)
+
+
+class FakeBackend:
+    def __init__(self, args):
+        self.args = args
+
+    async def has_capability(self, capability):
+        return False
+
+    async def select_folder(self, folder, readonly=False):
+        await asyncio.sleep(self.args.command_latency)
+        return {b'EXISTS': self.args.messages}
+
+    async def search(self, criteria='ALL', charset=None):
+        await asyncio.sleep(self.args.command_latency)
+        return list(range(1, self.args.messages + 1))
+
+    async def fetch(self, messages, data, modifiers=None):
+        await asyncio.sleep(self.args.command_latency +
+                            self.args.fetch_per_message * len(messages))
+        return {uid: {b'RFC822.SIZE': 1000} for uid in messages}
+
+    async def add_flags(self, messages, flags, silent=False):
+        await asyncio.sleep(self.args.command_latency)
+
+    async def disconnect(self):
+        pass
+
+    def connection_lost(self):
+        pass
+
+
+class LazyHandler(ImapHandler):
+    def __init__(self, args, **kwargs):
+        super().__init__(**kwargs)
+        self.args = args
+
+    async def get_backend(self, username, password):
+        await asyncio.sleep(self.args.login_latency)
+        return FakeBackend(self.args)
+
+
+class EagerHandler(LazyHandler):
+    # Reply to PASS only after the whole listing, as before.
+    async def handle_PASS(self, server, username, password):
+        status = await super().handle_PASS(server, username, password)
+        await self.get_sizes()
+        return status
+
+
+async def session(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    await reader.readline()
+    writer.write(b'USER bench\r\n')
+    await reader.readline()
+    t = time.perf_counter()
+    writer.write(b'PASS bench\r\nNOOP\r\nSTAT\r\n')
+    await reader.read(1)
+    first_byte = time.perf_counter() - t
+    await reader.readline()
+    await reader.readline()
+    noop = time.perf_counter() - t
+    await reader.readline()
+    stat = time.perf_counter() - t
+    writer.write(b'QUIT\r\n')
+    await reader.readline()
+    writer.close()
+    return first_byte, noop, stat
+
+
+async def run(args, handler_class):
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(
+        lambda: Pop3(handler_class(args, loop=loop), hostname='bench',
+                     loop=loop),
+        '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    result = await session(port)
+    server.close()
+    await server.wait_closed()
+    return result
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print('%-6s %12s %12s %12s' % ('mode', 'first byte', 'NOOP', 'STAT'))
+    for name, handler_class in (('eager', EagerHandler),
+                                ('lazy', LazyHandler)):
+        first_byte, noop, stat = loop.run_until_complete(
+            run(args, handler_class))
+        print('%-6s %10.1fms %10.1fms %10.1fms' %
+              (name, first_byte * 1e3, noop * 1e3, stat * 1e3))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
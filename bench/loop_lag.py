@@ -0,0 +1,145 @@
+"""Event loop lag while large and small messages are retrieved together.
+
+Clients in two child processes retrieve a large message with bare LF line
+endings and a small one in a loop, while the server measures how late a
+1 ms timer on its event loop fires. "inline" encodes every message on the
+event loop; "offload" encodes messages above the threshold in worker
+processes with aiopopd.encoder.MessageEncoder.
+
+Usage: python3 -m bench.loop_lag [-l LARGE_MB] [-d SECONDS]
+"""
+import time
+import asyncio
+import argparse
+import statistics
+import multiprocessing
+
+from aiopopd.pop import Pop3, OFFLOAD_THRESHOLD
+from aiopopd.encoder import MessageEncoder
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-l', '--large', type=int, default=50,
+                    help='size of the large message in MB')
+parser.add_argument('-s', '--small', type=int, default=10,
+                    help='size of the small message in KB')
+parser.add_argument('--large-clients', type=int, default=2)
+parser.add_argument('--small-clients', type=int, default=8)
+parser.add_argument('-d', '--duration', type=float, default=5)
+parser.add_argument('-t', '--threshold', type=int,
+                    default=OFFLOAD_THRESHOLD)
+
+
+def make_message(size):
+    # Bare LF line endings and dot lines, so both need encoding.
+    line = b'.' + b'x' * 75 + b'\n'
+    body = b'Subject: benchmark\n\n' + line * (size // len(line) + 1)
+    return body[:size]
+
+
+class MemoryHandler:
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def handle_RETR(self, server, n):
+        await server.push_message('+OK message follows', self.messages[n - 1])
+
+    def connection_lost(self):
+        pass
+
+
+async def retrieve(port, n, deadline, latencies):
+    reader, writer = await asyncio.open_connection(
+        '127.0.0.1', port, limit=2 ** 30)
+    await reader.readline()
+    writer.write(b'USER bench\r\nPASS bench\r\n')
+    await reader.readline()
+    await reader.readline()
+    while time.perf_counter() < deadline:
+        t = time.perf_counter()
+        writer.write(b'RETR %d\r\n' % n)
+        await reader.readuntil(b'\r\n.\r\n')
+        latencies.append(time.perf_counter() - t)
+    writer.write(b'QUIT\r\n')
+    await reader.readline()
+    writer.close()
+
+
+def client(port, n, clients, duration, results):
+    async def run():
+        latencies = []
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[retrieve(port, n, deadline, latencies)
+                               for _ in range(clients)])
+        return latencies
+
+    results.put((n, asyncio.run(run())))
+
+
+async def measure(args, encoder):
+    loop = asyncio.get_event_loop()
+    messages = [make_message(args.large * 1024 * 1024),
+                make_message(args.small * 1024)]
+    server = await loop.create_server(
+        lambda: Pop3(MemoryHandler(messages), hostname='bench', loop=loop,
+                     encoder=encoder),
+        '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=client, args=(
+            port, 1, args.large_clients, args.duration, results)),
+        multiprocessing.Process(target=client, args=(
+            port, 2, args.small_clients, args.duration, results)),
+    ]
+    for process in processes:
+        process.start()
+    lags = []
+    # Measure until both clients have reported.
+    collected = loop.run_in_executor(
+        None, lambda: dict(results.get() for _ in processes))
+    while not collected.done():
+        t = loop.time()
+        await asyncio.sleep(0.001)
+        lags.append(loop.time() - t - 0.001)
+    latencies = await collected
+    for process in processes:
+        await loop.run_in_executor(None, process.join)
+    server.close()
+    await server.wait_closed()
+    return lags, latencies[1], latencies[2]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    args = parser.parse_args()
+    print('%d clients retrieving %d MB, %d clients retrieving %d KB, '
+          'for %gs' % (args.large_clients, args.large, args.small_clients,
+                       args.small, args.duration))
+    print('%-8s %24s %20s %10s %10s' % (
+        'mode', 'loop lag p50/p99/max', 'small RETR p50/p99', 'large/s',
+        'small/s'))
+    for name, encoder in (
+            ('inline', None),
+            ('offload', MessageEncoder(threshold=args.threshold))):
+        if encoder is not None:
+            encoder.start()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        lags, large, small = loop.run_until_complete(measure(args, encoder))
+        loop.close()
+        if encoder is not None:
+            encoder.close()
+        print('%-8s %6.1f/%6.1f/%6.1f ms %7.1f/%7.1f ms %10.1f %10.0f' % (
+            name, statistics.median(lags) * 1e3,
+            percentile(lags, 0.99) * 1e3, max(lags) * 1e3,
+            statistics.median(small) * 1e3, percentile(small, 0.99) * 1e3,
+            len(large) / args.duration, len(small) / args.duration))
+
+
+if __name__ == '__main__':
+    main()
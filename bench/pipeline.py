@@ -0,0 +1,97 @@
+"""Pipelined POP3 commands per second, and per second of server CPU time.
+
+A client in a child process sends NOOP, STAT and LIST commands in one
+burst and reads the responses. The server runs in this process with a
+handler that answers from memory, so the numbers are the cost of the
+command loop and the response path.
+
+Usage: python3 -m bench.pipeline [-n COMMANDS] [-m MESSAGES]
+"""
+import time
+import socket
+import asyncio
+import argparse
+import multiprocessing
+
+from aiopopd.pop import Pop3
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--commands', type=int, default=30000)
+parser.add_argument('-m', '--messages', type=int, default=10)
+parser.add_argument('-r', '--repeat', type=int, default=3)
+
+
+class MemoryHandler:
+    def __init__(self, messages, done):
+        self.messages = messages
+        self.done = done
+
+    async def handle_STAT(self, server):
+        return '+OK %s %s' % (self.messages, self.messages * 1000)
+
+    async def handle_LIST(self, server, n):
+        if n > self.messages:
+            raise IndexError(n)
+        return 1000
+
+    def connection_lost(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+def client(port, commands, messages):
+    sock = socket.create_connection(('127.0.0.1', port))
+    burst = b'USER bench\r\nPASS bench\r\n'
+    burst += b'NOOP\r\nSTAT\r\nLIST\r\n' * (commands // 3) + b'QUIT\r\n'
+    # Greeting, USER, PASS, QUIT and the responses to each command triple.
+    expected = 4 + (commands // 3) * (1 + 1 + 1 + messages + 1)
+    sock.sendall(burst)
+    received = 0
+    with sock.makefile('rb') as fp:
+        for line in fp:
+            received += 1
+    sock.close()
+    assert received == expected, (received, expected)
+
+
+async def measure(args):
+    loop = asyncio.get_event_loop()
+    done = loop.create_future()
+    server = await loop.create_server(
+        lambda: Pop3(MemoryHandler(args.messages, done), hostname='bench',
+                     loop=loop),
+        '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    process = multiprocessing.Process(
+        target=client, args=(port, args.commands, args.messages))
+    t = time.perf_counter()
+    cpu = time.process_time()
+    process.start()
+    await done
+    elapsed = time.perf_counter() - t
+    cpu = time.process_time() - cpu
+    await loop.run_in_executor(None, process.join)
+    server.close()
+    await server.wait_closed()
+    if process.exitcode:
+        raise SystemExit('client failed')
+    return args.commands / elapsed, args.commands / cpu
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = [loop.run_until_complete(measure(args))
+               for _ in range(args.repeat)]
+    loop.close()
+    wall, cpu = max(results, key=lambda r: r[1])
+    print('%d pipelined commands (NOOP, STAT, LIST of %d messages)' %
+          (args.commands, args.messages))
+    print('%10.0f commands/s' % wall)
+    print('%10.0f commands per CPU second of the server' % cpu)
+
+
+if __name__ == '__main__':
+    main()
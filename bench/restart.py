@@ -0,0 +1,148 @@
+"""Upstream load of the first poll wave after a restart.
+
+Every account logs in at once, as after a restart. The upstream is
+simulated by a backend that sleeps for each command and counts the
+messages whose details it had to FETCH. "cold" is a restart without a
+snapshot; "snapshot" is a restart that loads the snapshot written by the
+previous run, while a few new messages have arrived in each account.
+
+Usage: python3 -m bench.restart [-a ACCOUNTS] [-m MESSAGES]
+"""
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+from aiopopd.pop import Pop3
+from aiopopd.imap import ImapHandler
+from aiopopd.snapshot import MailboxSnapshot
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-a', '--accounts', type=int, default=200)
+parser.add_argument('-m', '--messages', type=int, default=2000)
+parser.add_argument('--new-messages', type=int, default=5)
+parser.add_argument('--command-latency', type=float, default=0.02)
+parser.add_argument('--fetch-per-message', type=float, default=20e-6)
+
+
+class Upstream:
+    def __init__(self, args):
+        self.args = args
+        self.mailboxes = {}
+        self.fetched = 0
+        self.commands = 0
+
+    async def command(self, n=0):
+        self.commands += 1
+        await asyncio.sleep(self.args.command_latency +
+                            self.args.fetch_per_message * n)
+
+
+class FakeBackend:
+    def __init__(self, upstream, username):
+        self.upstream = upstream
+        self.uids = upstream.mailboxes[username]
+
+    async def has_capability(self, capability):
+        return False
+
+    async def select_folder(self, folder, readonly=False):
+        await self.upstream.command()
+        return {b'EXISTS': len(self.uids), b'UIDVALIDITY': 1}
+
+    async def search(self, criteria='ALL', charset=None):
+        await self.upstream.command(len(self.uids))
+        return list(self.uids)
+
+    async def fetch(self, messages, data, modifiers=None):
+        await self.upstream.command(len(messages))
+        self.upstream.fetched += len(messages)
+        return {uid: {b'RFC822.SIZE': 1000} for uid in messages}
+
+    async def disconnect(self):
+        pass
+
+    def connection_lost(self):
+        pass
+
+
+class BenchHandler(ImapHandler):
+    def __init__(self, upstream, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+
+    async def get_backend(self, username, password):
+        await self.upstream.command()
+        return FakeBackend(self.upstream, username)
+
+
+async def session(port, username):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    await reader.readline()
+    writer.write(('USER %s\r\nPASS x\r\nSTAT\r\nQUIT\r\n' %
+                  username).encode('ascii'))
+    lines = [await reader.readline() for _ in range(4)]
+    assert lines[3].startswith(b'+OK'), lines
+    writer.close()
+
+
+async def poll_wave(args, upstream, snapshot):
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(
+        lambda: Pop3(BenchHandler(upstream, loop=loop, snapshot=snapshot),
+                     hostname='bench', loop=loop),
+        '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    t = time.perf_counter()
+    await asyncio.gather(*[session(port, 'user%d' % i)
+                           for i in range(args.accounts)])
+    elapsed = time.perf_counter() - t
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+def run(args, path, use_snapshot):
+    upstream = Upstream(args)
+    for i in range(args.accounts):
+        upstream.mailboxes['user%d' % i] = list(range(1, args.messages + 1))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # The run before the restart, which leaves the snapshot behind.
+    snapshot = MailboxSnapshot(path) if use_snapshot else None
+    loop.run_until_complete(poll_wave(args, upstream, snapshot))
+    if snapshot is not None:
+        snapshot.write()
+    for uids in upstream.mailboxes.values():
+        uids.extend(range(args.messages + 1,
+                          args.messages + 1 + args.new_messages))
+    upstream.fetched = upstream.commands = 0
+    t = time.perf_counter()
+    snapshot = MailboxSnapshot(path) if use_snapshot else None
+    if snapshot is not None:
+        snapshot._load()
+    load = time.perf_counter() - t
+    elapsed = loop.run_until_complete(poll_wave(args, upstream, snapshot))
+    loop.close()
+    return elapsed, load, upstream.fetched, upstream.commands
+
+
+def main():
+    args = parser.parse_args()
+    print('%d accounts with %d messages, %d new after the restart' %
+          (args.accounts, args.messages, args.new_messages))
+    print('%-9s %10s %10s %14s %10s' %
+          ('restart', 'poll wave', 'load', 'fetched msgs', 'commands'))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'snapshot')
+        for name, use_snapshot in (('cold', False), ('snapshot', True)):
+            elapsed, load, fetched, commands = run(args, path, use_snapshot)
+            print('%-9s %8.0fms %8.1fms %14d %10d' %
+                  (name, elapsed * 1e3, load * 1e3, fetched, commands))
+        print('snapshot file: %d bytes' % os.path.getsize(path))
+
+
+if __name__ == '__main__':
+    main()
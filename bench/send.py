@@ -0,0 +1,132 @@
+"""Compare the per-line POP3 writer with the pre-stuffed send path.
+
+Usage: python3 -m bench.send [-r REPEAT]
+"""
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from aiopopd.pop import Pop3, dot_stuff
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-r', '--repeat', type=int, default=3)
+
+SIZES = [
+    ('1 KB', 1024),
+    ('100 KB', 100 * 1024),
+    ('20 MB', 20 * 1024 * 1024),
+]
+
+
+class NullWriter:
+    def __init__(self):
+        self.nbytes = 0
+        self.writes = 0
+        self.transport = self
+
+    def write(self, data):
+        self.nbytes += len(data)
+        self.writes += 1
+
+    async def drain(self):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+def make_message(size):
+    line = b'.' + b'x' * 74 + b'\r\n'
+    body = b'Subject: benchmark\r\n\r\n' + line * (size // len(line) + 1)
+    return body[:size]
+
+
+async def per_line(server, data):
+    # The writer used by Pop3.push_multi before the pre-stuffed send path.
+    await server.push('+OK message follows')
+    lines = data.split(b'\r\n') if data else []
+    for line in lines:
+        if line.startswith(b'.'):
+            line = b'.' + line
+        server._writer.write(line + b'\r\n')
+        await server._writer.drain()
+    await server.push('.')
+
+
+async def stuffed(server, data):
+    await server.push_stuffed('+OK message follows', dot_stuff(data))
+
+
+def measure(loop, server, fn, data):
+    server._writer = NullWriter()
+    tracemalloc.start()
+    t = time.perf_counter()
+    loop.run_until_complete(fn(server, data))
+    elapsed = time.perf_counter() - t
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, server._writer
+
+
+async def sendfile_throughput(loop, data):
+    # Send a pre-stuffed spool file over a local TCP connection.
+    received = 0
+    done = loop.create_future()
+
+    async def reader(r, w):
+        nonlocal received
+        while True:
+            chunk = await r.read(1 << 16)
+            if not chunk:
+                break
+            received += len(chunk)
+        w.close()
+        done.set_result(None)
+
+    srv = await asyncio.start_server(reader, '127.0.0.1', 0)
+    port = srv.sockets[0].getsockname()[1]
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    with tempfile.TemporaryFile() as fp:
+        fp.writelines(dot_stuff(data))
+        fp.seek(0)
+        t = time.perf_counter()
+        await loop.sendfile(writer.transport, fp)
+        writer.close()
+        await done
+        elapsed = time.perf_counter() - t
+    srv.close()
+    await srv.wait_closed()
+    return elapsed, received
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = Pop3(None, hostname='bench', loop=loop)
+    server.peer_str = 'bench'
+    print('%-8s %-10s %10s %12s %10s' %
+          ('size', 'writer', 'MB/s', 'peak alloc', 'writes'))
+    for label, size in SIZES:
+        data = make_message(size)
+        for name, fn in (('per-line', per_line), ('stuffed', stuffed)):
+            best = None
+            for _ in range(args.repeat):
+                result = measure(loop, server, fn, data)
+                if best is None or result[0] < best[0]:
+                    best = result
+            elapsed, peak, writer = best
+            print('%-8s %-10s %10.1f %12d %10d' %
+                  (label, name, size / elapsed / 1e6, peak, writer.writes))
+        elapsed, received = loop.run_until_complete(
+            sendfile_throughput(loop, data))
+        print('%-8s %-10s %10.1f %12s %10s' %
+              (label, 'sendfile', received / elapsed / 1e6, '-', '-'))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Time from starting aiopopd.server to the first "+OK" greeting.
+
+"listen" starts the server on a free port and polls until it accepts a
+connection. "activated" binds the socket first and passes it to the
+server as systemd socket activation does, so the client connects before
+the process exists and its greeting measures the whole cold start.
+"tls" is "listen" with --ssl-generate, which creates the key and
+certificate on each start.
+
+Usage: python3 -m bench.startup [-n RUNS]
+"""
+import os
+import ssl
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--runs', type=int, default=10)
+
+
+def server_command(path, port, extra=()):
+    return [sys.executable, '-m', 'aiopopd.server', '-n', '-d', 'bench',
+            '-p', path, '-P', str(port), '--reload-interval', '3600'] + list(
+                extra)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET6) as sock:
+        sock.bind(('::1', 0))
+        return sock.getsockname()[1]
+
+
+def greeting(port, tls):
+    deadline = time.perf_counter() + 30
+    while True:
+        try:
+            sock = socket.create_connection(('::1', port))
+            break
+        except ConnectionRefusedError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.001)
+    if tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        sock = context.wrap_socket(sock)
+    with sock:
+        line = sock.makefile('rb').readline()
+    assert line.startswith(b'+OK'), line
+
+
+def stop(process):
+    process.terminate()
+    process.wait()
+
+
+def run_listen(path, tls):
+    port = free_port()
+    extra = ()
+    if tls:
+        key = os.path.join(path, 'key.pem')
+        cert = os.path.join(path, 'cert.pem')
+        extra = ('--ssl-generate', '--ssl-key', key, '--ssl-cert', cert)
+    t = time.perf_counter()
+    process = subprocess.Popen(server_command(path, port, extra),
+                               stderr=subprocess.DEVNULL)
+    try:
+        greeting(port, tls)
+        return time.perf_counter() - t
+    finally:
+        stop(process)
+        if tls:
+            os.remove(key)
+            os.remove(cert)
+
+
+def run_activated(path):
+    sock = socket.socket(socket.AF_INET6)
+    sock.bind(('::1', 0))
+    sock.listen()
+    port = sock.getsockname()[1]
+
+    def activate():
+        # What systemd does between fork() and exec().
+        os.dup2(sock.fileno(), 3)
+        os.environ['LISTEN_FDS'] = '1'
+        os.environ['LISTEN_PID'] = str(os.getpid())
+
+    t = time.perf_counter()
+    process = subprocess.Popen(server_command(path, 0), preexec_fn=activate,
+                               pass_fds=(sock.fileno(),),
+                               stderr=subprocess.DEVNULL)
+    try:
+        greeting(port, False)
+        return time.perf_counter() - t
+    finally:
+        stop(process)
+        sock.close()
+
+
+def main():
+    args = parser.parse_args()
+    modes = (('listen', lambda path: run_listen(path, False)),
+             ('activated', run_activated),
+             ('tls', lambda path: run_listen(path, True)))
+    print('%-10s %10s %10s' % ('mode', 'median', 'min'))
+    with tempfile.TemporaryDirectory() as path:
+        for name, run in modes:
+            times = [run(path) for _ in range(args.runs)]
+            print('%-10s %8.1fms %8.1fms' % (
+                name, statistics.median(times) * 1e3, min(times) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+
+from aiopopd.imap_backend import _resolve
+from aiopopd.limiter import HostLimiter
+
+
+class CancelledWaiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_in_same_iteration_as_release(self):
+        # As when QUIT cancels a listing that waits for a slot, while
+        # another command completes.
+        limiter = HostLimiter('imap.example', initial=1)
+        await limiter.acquire('a')
+        waiter = asyncio.ensure_future(limiter.acquire('b'))
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.queued, 1)
+        waiter.cancel()
+        limiter.release('fetch', 0.01, False)
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.queued, 0)
+        await asyncio.wait_for(limiter.acquire('c'), 1)
+        self.assertEqual(limiter.in_flight, 1)
+
+    async def test_cancel_after_grant(self):
+        limiter = HostLimiter('imap.example', initial=1)
+        await limiter.acquire('a')
+        waiter = asyncio.ensure_future(limiter.acquire('b'))
+        await asyncio.sleep(0)
+        limiter.release('fetch', 0.01, False)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.queued, 0)
+
+    async def test_resolve_when_finished_raises(self):
+        future = asyncio.get_running_loop().create_future()
+
+        def finished(exn):
+            raise RuntimeError('release failed')
+
+        with self.assertRaises(RuntimeError):
+            _resolve(future, 'result', None, finished)
+        self.assertEqual(future.result(), 'result')
+
+
+class ConnectionLimitTest(unittest.IsolatedAsyncioTestCase):
+    async def test_wait_for_close(self):
+        limiter = HostLimiter('imap.example', max_connections=1)
+        await limiter.open_connection()
+        self.assertEqual(limiter.spare_connections(), 0)
+        cancelled = asyncio.ensure_future(limiter.open_connection())
+        waiter = asyncio.ensure_future(limiter.open_connection())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        limiter.close_connection()
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(limiter.connections, 1)
+        limiter.close_connection()
+        self.assertEqual(limiter.spare_connections(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()